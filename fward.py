@@ -1,241 +1,378 @@
 import os
 import sys
-import btrfs
-import yaml
-import subprocess
 import time
-from datetime import datetime, timedelta
+import random
+import signal
+import socket
+import threading
+from fward_models import *
+from fward_snapshot import *
 from fward_notifications import *
 from fward_env import *
-from re import search as re_search
-
-class BtrfsDeviceStats(yaml.YAMLObject):
-    yaml_tag = "!BtrfsDeviceStats"
-    yaml_loader = yaml.SafeLoader
-    def __init__(self, write_errors, read_errors, flush_errors, corruption_errors, generation_errors):
-        self.write_errors = write_errors
-        self.read_errors = read_errors
-        self.flush_errors = flush_errors
-        self.corruption_errors = corruption_errors
-        self.generation_errors = generation_errors
-    
-class BtrfsDevice(yaml.YAMLObject):
-    yaml_tag = "!BtrfsDevice"
-    yaml_loader = yaml.SafeLoader
-    def __init__(self, device, uuid, stats):
-        self.device = device
-        self.uuid = uuid
-        self.stats = stats
-
-class BtrfsMountPoint(yaml.YAMLObject):
-    yaml_tag = "!BtrfsMountPoint"
-    yaml_loader = yaml.SafeLoader
-    def __init__(self, mount_point, devices):
-        self.mount_point = mount_point
-        self.devices = devices
-
-class BtrfsMountChanges(yaml.YAMLObject):
-    yaml_tag = "!BtrfsMountChanges"
-    yaml_loader = yaml.SafeLoader
-    def __init__(self, added_mounts, removed_mounts, added_devices, removed_devices, changed_devices):
-        self.added_mounts = added_mounts
-        self.removed_mounts = removed_mounts
-        self.added_devices = added_devices
-        self.removed_devices = removed_devices
-        self.changed_devices = changed_devices
-
-# Read /etc/fstab and return a list of all the filesystems that are mounted using btrfs
-# We read the lines and then return a list of mount points.
-def find_btrfs_mount_points():
-    with open('/etc/fstab', 'r') as f:
-        lines = f.readlines()
-    mount_points = []
-    for line in lines:
-        if line.startswith('#'):
-            continue
-        if 'btrfs' in line:
-            mount_point = line.split()[1]
-            mount_points.append(mount_point)
-    return mount_points
-
-def get_all_btrfs_mounts():
-    mounts = []
-    mount_points = find_btrfs_mount_points()
-    for mount_point in mount_points:
-        mount = BtrfsMountPoint(mount_point, list())
-        with btrfs.FileSystem(mount_point) as fs:
-            # Loop over the devices and get their stats.
-            for device in fs.devices():
-                _info = fs.dev_info(device.devid)
-                _stats = fs.dev_stats(device.devid)
-                stats = BtrfsDeviceStats(
-                    write_errors=_stats.write_errs,
-                    read_errors=_stats.read_errs,
-                    flush_errors=_stats.flush_errs,
-                    corruption_errors=_stats.corruption_errs,
-                    generation_errors=_stats.generation_errs
-                )
-                dev = BtrfsDevice(_info.path, str(_info.uuid), stats)
-                mount.devices.append(dev)
-        mounts.append(mount)
-    return mounts
+from fward_journal import *
+from fward_resolve import *
+from fward_history import *
+from fward_mounts import *
+from fward_metrics import *
+from fward_profile import *
+from fward_backend import *
+from fward_scrub import *
+from fward_space import *
+from fward_subvolumes import *
+from fward_kmsg import *
+from fward_fleet import *
+from fward_messages import *
+
+# Keeps the filesystems of the backend open between scans, keyed by mount point.
+# The one-shot run opens and closes them per scan, the daemon keeps them for its lifetime.
+# Scans that did not finish in time are remembered, their handle stays open and is not scanned again until they finish.
+# The daemon also keeps the mount table, so mountinfo is only parsed again after a mount or unmount.
+class BtrfsFileSystemHandles:
+    def __init__(self, backend=None):
+        self.backend = backend or BtrfsBackend()
+        self.filesystems = {}
+        self.scans = {}
+        self.mount_table = None
+
+    def btrfs_filesystems(self):
+        if self.mount_table is None:
+            self.mount_table = self.backend.mount_table()
+        return self.mount_table.btrfs_filesystems()
+
+    def get(self, mount_point):
+        fs = self.filesystems.get(mount_point)
+        if fs is None:
+            fs = self.backend.open_filesystem(mount_point)
+            self.filesystems[mount_point] = fs
+        return fs
+
+    def drop(self, mount_point):
+        fs = self.filesystems.pop(mount_point, None)
+        if fs is not None:
+            fs.__exit__(None, None, None)
+
+    def busy(self, mount_point):
+        scan = self.scans.get(mount_point)
+        return scan is not None and scan.is_alive()
+
+    # Closes the handles of mount points that are no longer present.
+    def prune(self, mount_points):
+        for mount_point in [mp for mp in self.filesystems if mp not in mount_points and not self.busy(mp)]:
+            self.drop(mount_point)
+
+    # A handle that is still in use by a hung scan is left open, closing it could hand its number to another file.
+    def close(self):
+        for mount_point in list(self.filesystems):
+            if not self.busy(mount_point):
+                self.drop(mount_point)
+        if self.mount_table is not None:
+            self.mount_table.close()
+            self.mount_table = None
+
+# The backend to read from: the one given, the one of the handles, or else the real system.
+def choose_backend(backend, handles):
+    if backend is not None:
+        return backend
+    if handles is not None:
+        return handles.backend
+    return BtrfsBackend()
+
+def read_device_stats(fs, mount):
+    # Loop over the devices and get their stats.
+    for device in fs.devices():
+        _info = fs.dev_info(device.devid)
+        _stats = fs.dev_stats(device.devid)
+        stats = BtrfsDeviceStats(
+            write_errors=_stats.write_errs,
+            read_errors=_stats.read_errs,
+            flush_errors=_stats.flush_errs,
+            corruption_errors=_stats.corruption_errs,
+            generation_errors=_stats.generation_errs
+        )
+        dev = BtrfsDevice(_info.path, str(_info.uuid), stats)
+        mount.devices.append(dev)
+
+# Scans one filesystem on a daemon thread, so a filesystem that hangs in an ioctl can't keep fward from exiting.
+# At most as many scans as slots run at once. A scan that is given up on gets its slot released by the caller.
+# With a scrub_status_dir the scrubs of the devices are read as well, with a space_cache their space,
+# with a subvolume_cache their subvolumes and qgroups.
+class FilesystemScan(threading.Thread):
+    def __init__(self, mount_point, aliases, handles, keep_open, slots, changed, scrub_status_dir=None, space_cache=None, subvolume_cache=None):
+        super().__init__(daemon=True)
+        self.mount = BtrfsMountPoint(mount_point, list(), aliases)
+        self.scrub_status_dir = scrub_status_dir
+        self.scrubs = None
+        self.space_cache = space_cache
+        self.space = None
+        self.subvolume_cache = subvolume_cache
+        self.subvolumes = None
+        # (what, error) for every optional read that failed, the device stats are kept.
+        self.read_errors = []
+        self.handles = handles
+        self.keep_open = keep_open
+        self.slots = slots
+        self.changed = changed
+        self.lock = threading.Lock()
+        self.slot_held = False
+        self.started_at = None
+        self.duration = None
+        self.error = None
+        self.finished = False
+
+    def run(self):
+        self.slots.acquire()
+        with self.lock:
+            self.slot_held = True
+        self.started_at = time.monotonic()
+        self.changed.set()
+        mount_point = self.mount.mount_point
+        try:
+            try:
+                self.read(self.handles.get(mount_point))
+            except OSError:
+                if not self.keep_open:
+                    raise
+                # The handle may be stale after a remount, retry once with a fresh one.
+                self.handles.drop(mount_point)
+                self.mount.devices = list()
+                self.read(self.handles.get(mount_point))
+        except Exception as e:
+            self.error = e
+        self.duration = time.monotonic() - self.started_at
+        self.finished = True
+        self.release_slot()
+        self.changed.set()
+
+    def read(self, fs):
+        read_device_stats(fs, self.mount)
+        self.read_errors = []
+        backend = self.handles.backend
+        if self.scrub_status_dir is not None:
+            self.scrubs = self.read_optional('scrubs', backend.scrub_status, fs, self.scrub_status_dir)
+        if self.space_cache is not None:
+            self.space = self.read_optional('space', backend.space_status, fs, self.space_cache)
+        if self.subvolume_cache is not None:
+            self.subvolumes = self.read_optional('subvolumes', backend.subvolume_status, fs, self.subvolume_cache)
+
+    # The scrubs, space and subvolumes are read on their own, a failure there does not lose the device stats.
+    def read_optional(self, what, read, *args):
+        try:
+            return read(*args)
+        except Exception as e:
+            self.read_errors.append((what, e))
+            return None
+
+    def release_slot(self):
+        with self.lock:
+            if self.slot_held:
+                self.slot_held = False
+                self.slots.release()
+
+# The outcome of scanning all mounts.
+# unresponsive are the mount points that did not answer in time, their last known stats are in mounts.
+# timings has the scan duration in seconds per mount point.
+# scrubs has the DeviceScrub list per mount point, when scrubs were read.
+# space has the FilesystemSpace per mount point, when space was read.
+# subvolumes has the SubvolumeStatus per mount point, when subvolumes were read.
+# failed has the error per mount point that could not be scanned, their last known stats are in mounts like those
+# of the unresponsive ones. read_errors has the (what, error) per mount point of which a read besides the device
+# stats failed.
+class BtrfsScan:
+    def __init__(self, mounts, unresponsive, timings, scrubs=None, space=None, subvolumes=None, failed=None, read_errors=None):
+        self.mounts = mounts
+        self.unresponsive = unresponsive
+        self.failed = failed or {}
+        self.read_errors = read_errors or {}
+        self.timings = timings
+        self.scrubs = scrubs or {}
+        self.space = space or {}
+        self.subvolumes = subvolumes or {}
+
+# Scans all mounted btrfs filesystems, up to workers at the same time, giving each filesystem timeout seconds.
+# A filesystem mounted more than once, e.g. as several subvolumes, is scanned once under its first mount point.
+# When handles is given, the open filesystems are reused and kept open for the next scan, otherwise they are closed when done.
+# A filesystem that does not answer in time or fails to scan keeps its devices and stats from old_mounts,
+# so it doesn't show up as removed. The others are scanned as usual.
+# Without handles, the filesystems are read through backend, by default the real system.
+def scan_btrfs_mounts(handles=None, old_mounts=None, workers=4, timeout=30, backend=None, scrub_status_dir=None, space_cache=None, subvolume_cache=None):
+    keep_open = handles is not None
+    if not keep_open:
+        handles = BtrfsFileSystemHandles(backend)
+    try:
+        with profile_phase('discover'):
+            filesystems = handles.btrfs_filesystems() if keep_open else handles.backend.find_filesystems()
+        aliases = {mount_points[0]: mount_points[1:] for mount_points in filesystems}
+        mount_points = list(aliases)
+        handles.prune(mount_points)
+        slots = threading.Semaphore(max(1, workers))
+        changed = threading.Event()
+        scans = []
+        unresponsive = set()
+        with profile_phase('scan'):
+            for mount_point in mount_points:
+                # Still stuck from the previous scan, don't pile up another one.
+                if handles.busy(mount_point):
+                    unresponsive.add(mount_point)
+                    continue
+                scan = FilesystemScan(mount_point, aliases[mount_point], handles, keep_open, slots, changed, scrub_status_dir, space_cache, subvolume_cache)
+                handles.scans[mount_point] = scan
+                scan.start()
+                scans.append(scan)
+
+            # Wait until every scan finished or passed its deadline.
+            pending = list(scans)
+            while pending:
+                changed.clear()
+                now = time.monotonic()
+                next_deadline = None
+                for scan in list(pending):
+                    if scan.finished:
+                        pending.remove(scan)
+                    elif scan.started_at is not None:
+                        deadline = scan.started_at + timeout
+                        if now >= deadline:
+                            scan.release_slot()
+                            pending.remove(scan)
+                            unresponsive.add(scan.mount.mount_point)
+                        elif next_deadline is None or deadline < next_deadline:
+                            next_deadline = deadline
+                if pending:
+                    changed.wait(None if next_deadline is None else next_deadline - now)
+
+        failed = {scan.mount.mount_point: scan.error for scan in scans if scan.finished and scan.error is not None}
+        old_by_mount = {mount.mount_point: mount for mount in old_mounts or []}
+        finished = {scan.mount.mount_point: scan for scan in scans if scan.finished and scan.error is None}
+        mounts = []
+        for mount_point in mount_points:
+            if mount_point in finished:
+                mounts.append(finished[mount_point].mount)
+            elif mount_point in old_by_mount:
+                mounts.append(old_by_mount[mount_point])
+        timings = {mount_point: scan.duration for mount_point, scan in finished.items()}
+        scrubs = {mount_point: scan.scrubs for mount_point, scan in finished.items() if scan.scrubs is not None}
+        space = {mount_point: scan.space for mount_point, scan in finished.items() if scan.space is not None}
+        subvolumes = {mount_point: scan.subvolumes for mount_point, scan in finished.items() if scan.subvolumes is not None}
+        read_errors = {mount_point: scan.read_errors for mount_point, scan in finished.items() if scan.read_errors}
+        return BtrfsScan(mounts, sorted(unresponsive), timings, scrubs, space, subvolumes, failed, read_errors)
+    finally:
+        if not keep_open:
+            handles.close()
+
+def get_all_btrfs_mounts(handles=None, old_mounts=None, workers=4, timeout=30, backend=None):
+    return scan_btrfs_mounts(handles, old_mounts, workers, timeout, backend).mounts
         
 # Function that reads the cache file and returns the data.
 # If the file does not exist, it returns None.
-# We want to read the yaml back in to structures we can use.
+# We want to read the snapshot back in to structures we can use.
 # e.g. BtrfsMountPoint, BtrfsDevice, BtrfsDeviceStats
+# A YAML cache from an older version is converted to the current format once.
 def read_cache_file(cache_file):
     if not os.path.exists(cache_file):
         return None
-    with open(cache_file, 'r') as f:
-        data = yaml.safe_load(f)
-    return data
+    with open(cache_file, 'rb') as f:
+        data = f.read()
+    # A cache that can't be read is the same as none, the run writes a new one.
+    if is_legacy_snapshot(data):
+        mounts = loads_legacy_snapshot(data)
+        if mounts is None:
+            return None
+        write_cache_file(cache_file, mounts)
+        info(f'Converted cache file {cache_file} to the snapshot format')
+        return mounts
+    return loads_snapshot(data)
     
-# Writes cache to a file.
-def write_cache_file(cache_file, data):
-    with open(cache_file, 'w') as f:
-        yaml.dump(data, f)
+# Writes cache to a file, atomically so a crash can't leave a broken cache behind.
+# When old_data is given and nothing changed since, the file is left alone.
+def write_cache_file(cache_file, data, old_data=None):
+    if old_data is not None and encode_snapshot(old_data) == encode_snapshot(data):
+        return
+    write_file_atomic(cache_file, dumps_snapshot(data))
     
 # Function that compares the old and new mount data and returns the Mounts crossed with devices that have different stats.
 # It does this using the BtrfsMountChanges dataclass.
 # It always returns a BtrfsMountChanges object.
+# Both snapshots are indexed once by mount_point and (mount_point, uuid), so the diff is linear in the number of devices.
 def compare_mounts(old_mounts, new_mounts):
-    # Loop over new_mounts and check if their mount_point is in the old_mounts.
-    # If not, add them to the added_mounts list.
-    added_mounts = [mount for mount in new_mounts if mount.mount_point not in [old_mount.mount_point for old_mount in old_mounts]]
-    # Then the removed ones.
-    removed_mounts = [mount for mount in old_mounts if mount.mount_point not in [new_mount.mount_point for new_mount in new_mounts]]
-    # Then the changed once we do based on the devices.
-    # And the device ids.
-    # We add the mount as a tuple with the device.
-    mount_added_devices = [(mount, device) for mount in new_mounts for device in mount.devices if mount.mount_point in [old_mount.mount_point for old_mount in old_mounts] and device.uuid not in [old_device.uuid for old_mount in old_mounts for old_device in old_mount.devices]]
-    # Then the removed ones.
-    mount_removed_devices = [(mount, device) for mount in old_mounts for device in mount.devices if mount.mount_point in [new_mount.mount_point for new_mount in new_mounts] and device.uuid not in [new_device.uuid for new_mount in new_mounts for new_device in new_mount.devices]]
-    # Lastly we go over each mount point and each device and compare the attribubtes between the old and new mount points based on device id.
-    # If the stats are different, we add them to the changed_devices list.
+    old_mount_points = {mount.mount_point for mount in old_mounts}
+    new_mount_points = {mount.mount_point for mount in new_mounts}
+    old_devices = {(mount.mount_point, device.uuid): device for mount in old_mounts for device in mount.devices}
+    new_device_keys = {(mount.mount_point, device.uuid) for mount in new_mounts for device in mount.devices}
+
+    # Mounts that are only in one of the two.
+    added_mounts = [mount for mount in new_mounts if mount.mount_point not in old_mount_points]
+    removed_mounts = [mount for mount in old_mounts if mount.mount_point not in new_mount_points]
+
+    # For mounts in both we look at the devices.
+    # We add the mount as a tuple with the device, and for changed stats also the old device.
+    mount_added_devices = []
     mount_changed_devices = []
     for new_mount in new_mounts:
+        if new_mount.mount_point not in old_mount_points:
+            continue
         for new_device in new_mount.devices:
-            for old_mount in old_mounts:
-                if new_mount.mount_point == old_mount.mount_point:
-                    for old_device in old_mount.devices:
-                        if new_device.uuid == old_device.uuid:
-                            # Compare each of the stats.
-                            if new_device.stats.write_errors != old_device.stats.write_errors or new_device.stats.read_errors != old_device.stats.read_errors or new_device.stats.flush_errors != old_device.stats.flush_errors or new_device.stats.corruption_errors != old_device.stats.corruption_errors or new_device.stats.generation_errors != old_device.stats.generation_errors:
-                                mount_changed_devices.append((new_mount, new_device, old_device))
+            old_device = old_devices.get((new_mount.mount_point, new_device.uuid))
+            if old_device is None:
+                mount_added_devices.append((new_mount, new_device))
+            elif new_device.stats != old_device.stats:
+                mount_changed_devices.append((new_mount, new_device, old_device))
+    mount_removed_devices = [(mount, device) for mount in old_mounts if mount.mount_point in new_mount_points for device in mount.devices if (mount.mount_point, device.uuid) not in new_device_keys]
     return BtrfsMountChanges(added_mounts, removed_mounts, mount_added_devices, mount_removed_devices, mount_changed_devices)
 
-def get_broken_files(mounts, last_check_date_readable, current_date_readable):
+# The kinds of kernel messages about data that is still broken, and how its files are found:
+# a failed read by inode number, what scrub could not repair by logical address.
+BROKEN_FILE_REFERENCES = {'csum': 'inode', 'scrub': 'logical', 'unfixable': 'logical'}
+
+# Generator that reads the warning lines and yields ('inode' or 'logical', device, number, root) for each reference found.
+# root is the subvolume the inode is in, None when the kernel did not log it and for logical addresses.
+# Messages about the same block are only parsed into one reference.
+def find_broken_references(lines):
+    for message in unique_messages(parse_messages(unique_lines(lines))):
+        kind = BROKEN_FILE_REFERENCES.get(message.kind)
+        if kind == 'inode':
+            root = message.root if message.root is not None and is_subvolume(message.root) else None
+            yield ('inode', message.device, str(message.ino), root)
+        elif kind == 'logical':
+            yield ('logical', message.device, str(message.logical), None)
+
+# Returns the sorted paths of the references, warning about those on a device that is not mounted.
+def resolve_references(mounts, references, notifier=None, workers=4, handles=None, path_cache=None, backend=None):
+    backend = choose_backend(backend, handles)
+    # Grab the file names in-process, one worker per filesystem.
+    with profile_phase('resolve'):
+        broken_files, unknown = resolve_broken_files(mounts, references, workers, handles, path_cache, backend.resolve_filesystem)
+    for kind, device, number in unknown:
+        warn(f'Could not find mount point for device: {device}, with a broken file {kind}: {number}', notifier)
+
+    # Filter out the duplicates
+    broken_files = list(set(broken_files))
+    # Sort the list
+    broken_files.sort()
+    profile_count('paths_resolved', len(broken_files))
+    return broken_files
+
+# When reported is given, e.g. the BurstCollector of the daemon following the kernel log, the references it
+# reported recently are left out, and the ones reported here are added to it.
+def get_broken_files(mounts, journal, notifier=None, workers=4, handles=None, path_cache=None, backend=None, reported=None):
     try:
-        # Run the journalctl command for the time period
-        journalctl_command = [
-            'journalctl', '--grep', 'BTRFS warning', '--output', 'cat', '--since', last_check_date_readable, '--until', current_date_readable
-        ]
-
-        # Execute the command
-        p = subprocess.Popen(journalctl_command, stdout=subprocess.PIPE)
-        output, _ = p.communicate()
-
-        # Split the output by newlines, but remove the last empty line
-        output = output.decode().strip()
-
-        # Now we are going to get the 'ino' and 'logical' from the output
-        inos = []
-        logicals = []
-        for line in output.split('\n'):
-            # Get the device name
-            device = re_search(r'device (\w+)', line)
-            if not device:
-                continue
-            
-            # First look for the ino
-            ino = re_search(r'ino (\d+)', line)
-            if ino:
-                inos.append((device.group(1), ino.group(1)))
-            # Then look for the logical
-            logical = re_search(r'logical (\d+)', line)
-            if logical:
-                logicals.append((device.group(1), logical.group(1)))
-                
-        # Filter out the duplicates
-        inos = list(set(inos))
-        logicals = list(set(logicals))
-        
-        broken_files = []
-        
-        # Now we are going to grab the file names from the inos
-        for [device, ino] in inos:
-            # Get the mountpoint for the device
-            mount_point = None
-            for mount in mounts:
-                for dev in mount.devices:
-                    if dev.device == ("/dev/" + device):
-                        mount_point = mount.mount_point
-                        break
-                if mount_point:
-                    break
-            if not mount_point:
-                warn(f'Could not find mount point for device: {device}, with a broken file ino: {ino}', None)
-                continue
-            
-            # Run the btrfs inspect-internal inode-resolve command
-            btrfs_command = [
-                'btrfs', 'inspect-internal', 'inode-resolve', ino, mount_point
-            ]
-            # if the command returns a non-zero exit code, we skip it
-            try:
-                p = subprocess.Popen(btrfs_command, stdout=subprocess.PIPE)
-                output, _ = p.communicate()
-                output = output.decode().strip()
-                # Now we are going to get the file name
-                file_name = output.split('\n')[-1]
-                broken_files.append(file_name)
-            except subprocess.CalledProcessError as e:
-                error(f'Error while getting broken files: {e}', notifier)
-                continue
-            
-        for [device, logical] in logicals:
-            # Get the mountpoint for the device
-            mount_point = None
-            for mount in mounts:
-                for dev in mount.devices:
-                    if dev.device == ("/dev/" + device):
-                        mount_point = mount.mount_point
-                        break
-                if mount_point:
-                    break
-            if not mount_point:
-                warn(f'Could not find mount point for device: {device}, with a broken file logical: {logical}', notifier)
-                continue
-            
-            # Run the btrfs inspect-internal logical-resolve command
-            btrfs_command = [
-                'btrfs', 'inspect-internal', 'logical-resolve', logical, mount_point
-            ]
-            # if the command returns a non-zero exit code, we skip it
-            try:
-                p = subprocess.Popen(btrfs_command, stdout=subprocess.PIPE)
-                output, _ = p.communicate()
-                output = output.decode().strip()
-                # Now we are going to get the file name
-                file_name = output.split('\n')[-1]
-                broken_files.append(file_name)
-            except subprocess.CalledProcessError as e:
-                error(f'Error while getting broken files: {e}', notifier)
-                continue
-            
-        # Filter out the duplicates
-        broken_files = list(set(broken_files))
-        # Sort the list
-        broken_files.sort()
+        # Now we are going to get the 'ino' and 'logical' from the journal, line by line.
+        # The set filters out the duplicates as we go.
+        with profile_phase('journal'):
+            references = set(find_broken_references(journal.lines()))
+        profile_count('warnings', journal.lines_read)
+        if reported is not None:
+            references = reported.unreported(references, time.monotonic())
+        profile_count('references', len(references))
+        broken_files = resolve_references(mounts, references, notifier, workers, handles, path_cache, backend)
+        if reported is not None:
+            reported.mark_reported(references, time.monotonic())
         return broken_files
     except Exception as e:
-        error(f'Error while getting broken files: {e}', None)
+        error(f'Error while getting broken files: {e}', notifier)
         return None
     
 # Class to create a lock file
 lock_filename = '/tmp/fward.lock'
-def lock_file():
+def lock_file(notifier=None):
     # Try to create the file, if it exists we exit gracefully with a message.
     try:
         lock_fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_RDWR)
@@ -248,122 +385,633 @@ def lock_file():
 def unlock_file():
     os.remove(lock_filename)
 
+# Reads the environment variables and prepares the data and config directories.
+# Created once per run, and again when the daemon reloads.
+class FwardConfig:
+    def __init__(self):
+        self.data_dir = get_environment_variable('FWARD_DATA_DIR', '/var/fward/data')
+        create_directory(self.data_dir)
+        check_write_permission(self.data_dir)
+        self.config_dir = get_environment_variable('FWARD_CONFIG_DIR', '/var/fward/config')
+        create_directory(self.config_dir)
+        check_write_permission(self.config_dir)
+
+        cache_file_name = get_environment_variable('FWARD_CACHE_NAME', 'devices.cache')
+        self.cache_file = os.path.join(self.data_dir, cache_file_name)
+        notifier_config_name = get_environment_variable('FWARD_NOTIFIER_FILE', 'notifier.conf')
+        self.notifier_config = os.path.join(self.config_dir, notifier_config_name)
+        self.notify_state_file = get_environment_variable('FWARD_NOTIFY_STATE_FILE', os.path.join(self.data_dir, 'notify.state'))
+        self.notify_cooldown = float(get_environment_variable('FWARD_NOTIFY_COOLDOWN', '0'))
+        self.notify_timeout = float(get_environment_variable('FWARD_NOTIFY_TIMEOUT', '30'))
+        self.notify_retries = int(get_environment_variable('FWARD_NOTIFY_RETRIES', '2'))
+        self.last_check_file = get_environment_variable('FWARD_LAST_CHECK_FILE', os.path.join(self.data_dir, 'last_check'))
+        self.journal_cursor_file = get_environment_variable('FWARD_JOURNAL_CURSOR_FILE', os.path.join(self.data_dir, 'journal.cursor'))
+        self.journal_backlog = int(get_environment_variable('FWARD_JOURNAL_BACKLOG', '10000'))
+        self.scan_workers = int(get_environment_variable('FWARD_SCAN_WORKERS', '4'))
+        self.scan_timeout = float(get_environment_variable('FWARD_SCAN_TIMEOUT', '30'))
+        self.resolve_workers = int(get_environment_variable('FWARD_RESOLVE_WORKERS', '4'))
+        self.path_cache_file = get_environment_variable('FWARD_PATH_CACHE_FILE', os.path.join(self.data_dir, 'paths.cache'))
+        self.path_cache_size = int(get_environment_variable('FWARD_PATH_CACHE_SIZE', '10000'))
+
+        self.history_dir = get_environment_variable('FWARD_HISTORY_DIR', os.path.join(self.data_dir, 'history'))
+        self.history_raw_hours = int(get_environment_variable('FWARD_HISTORY_RAW_HOURS', '24'))
+        self.history_hourly_days = int(get_environment_variable('FWARD_HISTORY_HOURLY_DAYS', '365'))
+        self.rate_alert_per_hour = int(get_environment_variable('FWARD_RATE_ALERT_PER_HOUR', '0'))
+        self.rate_alert_per_day = int(get_environment_variable('FWARD_RATE_ALERT_PER_DAY', '0'))
+
+        self.daemon_interval = float(get_environment_variable('FWARD_DAEMON_INTERVAL', '60'))
+        self.daemon_jitter = float(get_environment_variable('FWARD_DAEMON_JITTER', '10'))
+        self.follow_debounce = float(get_environment_variable('FWARD_FOLLOW_DEBOUNCE', '2'))
+        self.follow_max_delay = float(get_environment_variable('FWARD_FOLLOW_MAX_DELAY', '10'))
+        self.follow_hold = float(get_environment_variable('FWARD_FOLLOW_HOLD', '3600'))
+
+        self.scrub_monitor = get_environment_variable('FWARD_SCRUB_MONITOR', '1') == '1'
+        self.scrub_status_dir = get_environment_variable('FWARD_SCRUB_STATUS_DIR', SCRUB_STATUS_DIR)
+        self.scrub_state_file = get_environment_variable('FWARD_SCRUB_STATE_FILE', os.path.join(self.data_dir, 'scrub.state'))
+        self.scrub_max_age_days = float(get_environment_variable('FWARD_SCRUB_MAX_AGE_DAYS', '0'))
+
+        self.space_monitor = get_environment_variable('FWARD_SPACE_MONITOR', '1') == '1'
+        self.space_cache_file = get_environment_variable('FWARD_SPACE_CACHE_FILE', os.path.join(self.data_dir, 'space.cache'))
+        self.space_refresh_interval = float(get_environment_variable('FWARD_SPACE_REFRESH_INTERVAL', '3600'))
+        self.space_min_unallocated_gib = float(get_environment_variable('FWARD_SPACE_MIN_UNALLOCATED_GIB', '1'))
+        self.space_metadata_usage = float(get_environment_variable('FWARD_SPACE_METADATA_USAGE', '80'))
+
+        self.subvolume_monitor = get_environment_variable('FWARD_SUBVOLUME_MONITOR', '1') == '1'
+        self.subvolume_cache_file = get_environment_variable('FWARD_SUBVOLUME_CACHE_FILE', os.path.join(self.data_dir, 'subvolumes.cache'))
+        self.subvolume_refresh_interval = float(get_environment_variable('FWARD_SUBVOLUME_REFRESH_INTERVAL', '86400'))
+        self.qgroup_limit_usage = float(get_environment_variable('FWARD_QGROUP_LIMIT_USAGE', '90'))
+        self.qgroup_growth_gib_per_day = float(get_environment_variable('FWARD_QGROUP_GROWTH_GIB_PER_DAY', '0'))
+
+        self.run_summary_file = get_environment_variable('FWARD_RUN_SUMMARY_FILE', os.path.join(self.data_dir, 'run_summary.json'))
+        self.profile_stats_file = get_environment_variable('FWARD_PROFILE_STATS_FILE', '')
+
+        self.metrics_textfile = get_environment_variable('FWARD_METRICS_TEXTFILE', '')
+        self.metrics_address = get_environment_variable('FWARD_METRICS_ADDRESS', '127.0.0.1')
+        self.metrics_port = int(get_environment_variable('FWARD_METRICS_PORT', '0'))
+
+        self.agent_url = get_environment_variable('FWARD_AGENT_URL', '')
+        self.agent_host = get_environment_variable('FWARD_AGENT_HOST', socket.gethostname())
+        self.agent_timeout = float(get_environment_variable('FWARD_AGENT_TIMEOUT', '10'))
+        self.agent_spool_file = get_environment_variable('FWARD_AGENT_SPOOL_FILE', os.path.join(self.data_dir, 'agent.spool'))
+        self.agent_state_file = get_environment_variable('FWARD_AGENT_STATE_FILE', os.path.join(self.data_dir, 'agent.state'))
+        self.agent_spool_max_bytes = int(get_environment_variable('FWARD_AGENT_SPOOL_MAX_BYTES', str(16 << 20)))
+
+        self.collector_address = get_environment_variable('FWARD_COLLECTOR_ADDRESS', '127.0.0.1')
+        self.collector_port = int(get_environment_variable('FWARD_COLLECTOR_PORT', '9102'))
+        self.collector_socket = get_environment_variable('FWARD_COLLECTOR_SOCKET', '')
+        self.collector_store_file = get_environment_variable('FWARD_COLLECTOR_STORE_FILE', os.path.join(self.data_dir, 'fleet.store'))
+        self.collector_save_interval = float(get_environment_variable('FWARD_COLLECTOR_SAVE_INTERVAL', '10'))
+        self.collector_stale_after = float(get_environment_variable('FWARD_COLLECTOR_STALE_AFTER', '900'))
+
+# Returns a collector that sends the notifications of a run as one digest, or None without a notifier config.
+# The config itself is only read once there is something to send.
+def load_notifier(config):
+    if not os.path.exists(config.notifier_config):
+        error(f'Could not find notifier config file: {config.notifier_config}, notifications will not be sent.')
+        return None
+    info(f'Notifier config: {config.notifier_config}')
+    return NotificationCollector(config.notifier_config, config.notify_state_file, config.notify_cooldown, config.notify_timeout, config.notify_retries)
+
+# Returns the agent that ships the runs to the collector, or None without FWARD_AGENT_URL.
+def load_agent(config):
+    if not config.agent_url:
+        return None
+    return FleetAgent(config.agent_url, config.agent_host, config.agent_spool_file, config.agent_state_file, config.agent_spool_max_bytes, config.agent_timeout)
+
+# Ships the spooled reports, an unreachable collector only gets logged, the reports stay spooled.
+def ship_reports(agent):
+    try:
+        with profile_phase('ship'):
+            shipped = agent.ship()
+        profile_count('reports_shipped', shipped)
+    except OSError as e:
+        agent.close()
+        warn(f'Could not reach the collector at {agent.url}, the reports stay spooled: {e}')
+
+# Print out all the mounts and devices.
+def print_mounts(mounts):
+    for mount in mounts:
+        print(f'Mount point: {mount.mount_point}')
+        for alias in mount.aliases:
+            print(f'    Also mounted at: {alias}')
+        for device in mount.devices:
+            print(f'    Device: {device.device} UUID: {device.uuid}')
+            print(f'        Write errors: {device.stats.write_errors}')
+            print(f'        Read errors: {device.stats.read_errors}')
+            print(f'        Flush errors: {device.stats.flush_errors}')
+            print(f'        Corruption errors: {device.stats.corruption_errors}')
+            print(f'        Generation errors: {device.stats.generation_errors}')
+
+# Reports every change to the log and the notifier.
+def report_changes(changes, notifier):
+    if changes.added_mounts:
+        for mount in changes.added_mounts:
+            info(f'Added mount: {mount.mount_point}', notifier, mount.mount_point)
+    if changes.removed_mounts:
+        for mount in changes.removed_mounts:
+            warn(f'Removed mount: {mount.mount_point}', notifier, mount.mount_point)
+    if changes.added_devices:
+        for mount, device in changes.added_devices:
+            info(f'Added device: {device.device} to {mount.mount_point}', notifier, mount.mount_point)
+    if changes.removed_devices:
+        for mount, device in changes.removed_devices:
+            warn(f'Removed device: {device.device} from {mount.mount_point}', notifier, mount.mount_point)
+            
+    if changes.changed_devices:
+        for mount, new_device, old_device in changes.changed_devices:
+            error(f'Changed stats of device: {new_device.device} in {mount.mount_point}\nWrite errors: {old_device.stats.write_errors} -> {new_device.stats.write_errors}\nRead errors: {old_device.stats.read_errors} -> {new_device.stats.read_errors}\nFlush errors: {old_device.stats.flush_errors} -> {new_device.stats.flush_errors}\nCorruption errors: {old_device.stats.corruption_errors} -> {new_device.stats.corruption_errors}\nGeneration errors: {old_device.stats.generation_errors} -> {new_device.stats.generation_errors}', notifier, mount.mount_point)
+    # if none of the above are true, we are done.
+    if not changes.added_mounts and not changes.removed_mounts and not changes.added_devices and not changes.removed_devices and not changes.changed_devices:
+        info('No changes in mounts or devices.')
+    else:
+        # The changes themselves are already in the digest.
+        info('Changes found in mounts or devices.')
+
+# Reports the scrubs that started, ended, found new errors or are overdue, and logs the progress of running ones.
+def report_scrubs(scrubs, config, notifier):
+    monitor = ScrubMonitor(config.scrub_state_file, config.scrub_max_age_days * 86400)
+    now = time.time()
+    for mount_point, device_scrubs in scrubs.items():
+        for scrub in device_scrubs:
+            for level, message in monitor.check(mount_point, scrub, now):
+                if level == 'progress':
+                    info(message)
+                elif level == 'info':
+                    info(message, notifier, mount_point)
+                elif level == 'warn':
+                    warn(message, notifier, mount_point)
+                else:
+                    error(message, notifier, mount_point)
+    monitor.save()
+
+# Prints the allocation of every filesystem and of its devices.
+def print_space(space):
+    for mount_point, filesystem in space.items():
+        print(f'Space of {mount_point}:')
+        for space_type, (allocated, used) in filesystem.types.items():
+            print(f'    {space_type.capitalize()}, {filesystem.profiles[space_type]}: {format_bytes(used)} used of {format_bytes(allocated)} allocated')
+        print(f'    Global reserve: {format_bytes(filesystem.global_reserve)}')
+        for device in filesystem.devices:
+            by_type = ', '.join(f'{space_type} {format_bytes(size)}' for space_type, size in device.by_type.items())
+            print(f'    Device: {device.device} size {format_bytes(device.size)}, unallocated {format_bytes(device.unallocated())} ({by_type})')
+
+# Alerts when a filesystem needs a balance, once a day for as long as it does.
+def report_space(space, cache, config, notifier):
+    now = time.time()
+    min_unallocated = config.space_min_unallocated_gib * GIB
+    for mount_point, filesystem in space.items():
+        for message in cache.due_alerts(mount_point, space_problems(mount_point, filesystem, min_unallocated, config.space_metadata_usage / 100), now):
+            warn(message, notifier, mount_point)
+    cache.save()
+
+# Prints the subvolumes of every filesystem, with the usage of their qgroups.
+def print_subvolumes(subvolumes):
+    for mount_point, status in subvolumes.items():
+        print(f'Subvolumes of {mount_point}: {len(status.subvolumes)}, {status.reread} read again')
+        for qgroup in status.qgroups.values():
+            limits = ''.join(f', limit {kind} {format_bytes(limit)}' for kind, limit in (('referenced', qgroup.max_referenced), ('exclusive', qgroup.max_exclusive)) if limit)
+            growth = f', growing {format_bytes(qgroup.growth)} per day' if qgroup.growth is not None and qgroup.growth > 0 else ''
+            print(f'    Qgroup {qgroup.name} {qgroup.path or ""}: referenced {format_bytes(qgroup.referenced)}, exclusive {format_bytes(qgroup.exclusive)}{limits}{growth}')
+
+# Alerts when a qgroup nears its limit or grows too fast, once a day for as long as it does.
+def report_subvolumes(subvolumes, cache, config, notifier):
+    now = time.time()
+    growth_per_day = config.qgroup_growth_gib_per_day * GIB
+    for mount_point, status in subvolumes.items():
+        for message in cache.due_alerts(mount_point, qgroup_problems(mount_point, status, config.qgroup_limit_usage / 100, growth_per_day), now):
+            warn(message, notifier, mount_point)
+    cache.save()
+
+# Checks the journal for broken files logged since the stored cursor.
+# The cursor is only moved forward when the check succeeded.
+def check_broken_files(mounts, config, notifier, handles=None, path_cache=None, backend=None, reported=None):
+    backend = choose_backend(backend, handles)
+    since = None
+    if os.path.exists(config.last_check_file):
+        # Left behind by versions that used timestamps, it limits the first cursor based read.
+        with open(config.last_check_file, 'r') as file:
+            since = int(file.read().strip())
+    journal = backend.journal(config.journal_cursor_file, MESSAGE_GREP, config.journal_backlog, since)
+    if path_cache is None:
+        path_cache = PathCache(config.path_cache_file, config.path_cache_size)
+    broken_files = get_broken_files(mounts, journal, notifier, config.resolve_workers, handles, path_cache, backend, reported)
+    if broken_files is not None:
+        journal.commit()
+        with profile_phase('path_cache'):
+            path_cache.save()
+    if '--debug' in sys.argv:
+        print(f'Path cache: {path_cache.hits} hits, {path_cache.misses} misses, {len(path_cache.entries)} entries')
+    return broken_files
+
+# One pass of the monitor: scan, compare against the previous snapshot and look for broken files.
+# Returns the snapshot the next pass should compare against.
+# When metrics is given, it is updated with what the pass found, publishing is up to the caller.
+# When reported is given, broken files it holds as reported already are left out, see get_broken_files.
+# When agent is given, the snapshot or the changes are spooled for the collector, shipping is up to the caller.
+def run_check(config, notifier, old_mounts, handles=None, path_cache=None, metrics=None, backend=None, agent=None, reported=None):
+    backend = choose_backend(backend, handles)
+    started = time.monotonic()
+    scrub_status_dir = config.scrub_status_dir if config.scrub_monitor else None
+    space_cache = SpaceCache(config.space_cache_file, config.space_refresh_interval) if config.space_monitor else None
+    subvolume_cache = SubvolumeCache(config.subvolume_cache_file, config.subvolume_refresh_interval) if config.subvolume_monitor else None
+    scan = scan_btrfs_mounts(handles, old_mounts, config.scan_workers, config.scan_timeout, backend, scrub_status_dir, space_cache, subvolume_cache)
+    mounts = scan.mounts
+    profile_count('mounts', len(mounts))
+    profile_count('devices', sum(len(mount.devices) for mount in mounts))
+    profile_count('unresponsive', len(scan.unresponsive))
+    profile_count('failed', len(scan.failed))
+    if metrics is not None:
+        metrics.update_scan(scan, time.monotonic() - started, time.time())
+    if '--debug' in sys.argv:
+        print_mounts(mounts)
+        for mount_point, duration in scan.timings.items():
+            print(f'Scanned {mount_point} in {duration * 1000:.1f} ms')
+        print_space(scan.space)
+        print_subvolumes(scan.subvolumes)
+    for mount_point in scan.unresponsive:
+        error(f'Filesystem {mount_point} is unresponsive, it did not answer within {config.scan_timeout:g} seconds. Using its last known stats.', notifier, mount_point)
+    for mount_point, e in scan.failed.items():
+        error(f'Could not scan filesystem {mount_point}: {e}. Using its last known stats.', notifier, mount_point)
+    for mount_point, read_errors in scan.read_errors.items():
+        for what, e in read_errors:
+            error(f'Could not read the {what} of {mount_point}: {e}', notifier, mount_point)
+    # If there are no mounts, say so
+    if not mounts:
+        warn('No btrfs mounts found', notifier)
+        return old_mounts
+    
+    with profile_phase('cache_write'):
+        write_cache_file(config.cache_file, mounts, old_mounts)
+    with profile_phase('history'):
+        record_history(config.history_dir, mounts, time.time(), config.history_raw_hours, config.history_hourly_days)
+    if scan.scrubs:
+        with profile_phase('scrub'):
+            report_scrubs(scan.scrubs, config, notifier)
+    if space_cache is not None:
+        with profile_phase('space'):
+            report_space(scan.space, space_cache, config, notifier)
+    if subvolume_cache is not None:
+        with profile_phase('subvolumes'):
+            report_subvolumes(scan.subvolumes, subvolume_cache, config, notifier)
+    
+    if old_mounts is None:
+        warn('No old cache found', notifier)
+        if agent is not None:
+            agent.record(mounts)
+        return mounts
+    
+    # Compare the old and new mounts
+    with profile_phase('compare'):
+        changes = compare_mounts(old_mounts, mounts)
+    report_changes(changes, notifier)
+    if agent is not None:
+        agent.record(mounts, changes)
+
+    # Now we are going to check for broken files.
+    # Resolving paths on an unresponsive filesystem would hang as well, and fail on one that failed to scan.
+    responsive = [mount for mount in mounts if mount.mount_point not in scan.unresponsive and mount.mount_point not in scan.failed]
+    broken_files = check_broken_files(responsive, config, notifier, handles, path_cache, backend, reported)
+    if metrics is not None and broken_files is not None:
+        metrics.update_broken_files(len(broken_files))
+    if broken_files:
+        paths = '\n'.join(broken_files)
+        error(f'Broken files detected:\n{paths}', notifier)
+    else:
+        info("Nothing broken detected")
+    return mounts
+
+# Starts timing a run, when there is a summary to write or --profile asks for the breakdown.
+def begin_run(config):
+    if config.run_summary_file or '--profile' in sys.argv:
+        start_profile()
+
+# Writes the summary of the run and prints the breakdown with --profile.
+def end_run(config):
+    profile = stop_profile()
+    if profile is None:
+        return
+    if config.run_summary_file:
+        write_run_summary(config.run_summary_file, profile)
+    if '--profile' in sys.argv:
+        profile.print_breakdown()
+
+def flush_notifier(notifier):
+    with profile_phase('notify'):
+        sent = notifier.flush()
+    profile_count('notifications_sent', sent)
+
+# Prints the errors per hour and per day of every device with a history.
+# Alerts when FWARD_RATE_ALERT_PER_HOUR or FWARD_RATE_ALERT_PER_DAY is reached.
+def report_rates(config, notifier):
+    now = int(time.time())
+    # Names of the devices as last seen.
+    names = {}
+    for mount in read_cache_file(config.cache_file) or []:
+        for device in mount.devices:
+            names.setdefault(device.uuid, (device.device, mount.mount_point))
+    print(f'{"Device":<20} {"UUID":<36} {"Errors/hour":>12} {"Errors/day":>12}  Mount point')
+    for uuid in history_uuids(config.history_dir):
+        per_hour, per_day = error_rates(config.history_dir, uuid, now, config.history_raw_hours, config.history_hourly_days)
+        device, mount_point = names.get(uuid, ('-', '-'))
+        print(f'{device:<20} {uuid:<36} {per_hour:>12} {per_day:>12}  {mount_point}')
+        if config.rate_alert_per_hour and per_hour >= config.rate_alert_per_hour:
+            error(f'Device {device} ({uuid}) in {mount_point} had {per_hour} errors in the last hour', notifier, mount_point)
+        if config.rate_alert_per_day and per_day >= config.rate_alert_per_day:
+            error(f'Device {device} ({uuid}) in {mount_point} had {per_day} errors in the last day', notifier, mount_point)
+
+# Stays resident and runs the check on an interval.
+# The notifier, the open filesystems and the previous snapshot are kept in memory between passes.
+# With FWARD_METRICS_PORT set it serves the metrics of the last pass, scrapes don't cause extra scans.
+# SIGHUP reloads the configuration, SIGTERM and SIGINT stop after the current pass.
+# With follow, the kernel log is followed between the passes and broken files are reported as they are logged.
+# Every pass still reads the journal, so its cursor keeps up and a restart doesn't report again what was reported
+# live. Broken files reported by one of the two are held for FWARD_FOLLOW_HOLD seconds, the other leaves them out.
+class FwardDaemon:
+    def __init__(self, config, notifier, backend=None, follow=False):
+        self.config = config
+        self.notifier = notifier
+        self.agent = load_agent(config)
+        self.handles = BtrfsFileSystemHandles(backend)
+        self.path_cache = PathCache(config.path_cache_file, config.path_cache_size)
+        self.old_mounts = read_cache_file(config.cache_file)
+        self.metrics = FwardMetrics(config.metrics_textfile)
+        self.metrics_server = None
+        self.follow = follow
+        self.kernel_log = None
+        self.bursts = BurstCollector(config.follow_debounce, config.follow_max_delay, config.follow_hold)
+        self.running = True
+        self.reload_requested = False
+
+    def request_stop(self, signum, frame):
+        self.running = False
+
+    def request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def reload(self):
+        info('Reloading configuration')
+        if self.notifier:
+            self.notifier.flush()
+        self.config = FwardConfig()
+        self.notifier = load_notifier(self.config)
+        if self.agent is not None:
+            self.agent.close()
+        self.agent = load_agent(self.config)
+        # Reopen the filesystems on the next pass, mounts may have changed.
+        self.handles.close()
+        self.path_cache = PathCache(self.config.path_cache_file, self.config.path_cache_size)
+        self.metrics.textfile = self.config.metrics_textfile
+        self.stop_metrics_server()
+        self.start_metrics_server()
+        self.bursts = BurstCollector(self.config.follow_debounce, self.config.follow_max_delay, self.config.follow_hold)
+
+    def start_metrics_server(self):
+        if self.config.metrics_port:
+            self.metrics_server = start_metrics_server(self.metrics, self.config.metrics_address, self.config.metrics_port)
+            info(f'Serving metrics on http://{self.config.metrics_address}:{self.config.metrics_port}/metrics')
+
+    def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+
+    def start_following(self):
+        try:
+            self.kernel_log = self.handles.backend.kernel_log(MESSAGE_GREP)
+            info(f'Following the kernel log through {self.kernel_log.source}')
+        except Exception as e:
+            error(f'Could not follow the kernel log: {e}', self.notifier)
+
+    def stop_following(self):
+        if self.kernel_log is not None:
+            self.kernel_log.close()
+            self.kernel_log = None
+
+    # Reads what the kernel logged, and reports a burst of broken files once it is over.
+    def follow_kernel_log(self, timeout):
+        try:
+            lines = self.kernel_log.poll(timeout)
+        except Exception as e:
+            # Started again on the next pass, the journal check covers the gap.
+            error(f'Stopped following the kernel log: {e}', self.notifier)
+            self.stop_following()
+            return
+        now = time.monotonic()
+        for reference in find_broken_references(lines):
+            self.bursts.add(reference, now)
+        if self.bursts.ready(now):
+            self.report_burst(self.bursts.take(now))
+
+    # Resolving paths on an unresponsive filesystem would hang as well, and fail on one that failed to scan.
+    def resolvable_mounts(self):
+        return [mount for mount in self.old_mounts or [] if mount.mount_point not in self.metrics.unresponsive and mount.mount_point not in self.metrics.failed]
+
+    def report_burst(self, references):
+        broken_files = resolve_references(self.resolvable_mounts(), references, self.notifier, self.config.resolve_workers, self.handles, self.path_cache)
+        self.path_cache.save()
+        if broken_files:
+            paths = '\n'.join(broken_files)
+            error(f'Broken files detected:\n{paths}', self.notifier)
+        if self.notifier:
+            try:
+                self.notifier.flush()
+            except Exception as e:
+                error(f'Could not send notifications: {e}')
+
+    # On the way out the pending burst is reported and the journal is read up to now, what was reported live
+    # is left out. The next start then reads on from there, and doesn't report it again.
+    def finish_following(self):
+        if self.kernel_log is None or self.old_mounts is None:
+            return
+        try:
+            if self.bursts.pending:
+                self.report_burst(self.bursts.take(time.monotonic()))
+            check_broken_files(self.resolvable_mounts(), self.config, self.notifier, self.handles, self.path_cache, reported=self.bursts)
+            if self.notifier:
+                flush_notifier(self.notifier)
+        except Exception as e:
+            error(f'Could not read the journal up to now: {e}')
+
+    # Sleeps until the next pass is due, waking up early on a signal.
+    # While following the kernel log, it waits for new lines instead, or for the end of a burst.
+    def wait(self, started):
+        deadline = started + self.config.daemon_interval + random.uniform(0, self.config.daemon_jitter)
+        while self.running and not self.reload_requested:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.kernel_log is None:
+                time.sleep(min(remaining, 1))
+                continue
+            burst = self.bursts.deadline()
+            if burst is not None:
+                remaining = min(remaining, max(0, burst - time.monotonic()))
+            self.follow_kernel_log(min(remaining, 1))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        info(f'Running as daemon, checking every {self.config.daemon_interval:g} seconds')
+        try:
+            self.start_metrics_server()
+            while self.running:
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                if self.follow and self.kernel_log is None:
+                    self.start_following()
+                started = time.monotonic()
+                begin_run(self.config)
+                try:
+                    self.old_mounts = run_check(self.config, self.notifier, self.old_mounts, self.handles, self.path_cache, self.metrics, agent=self.agent, reported=self.bursts)
+                    with profile_phase('metrics'):
+                        self.metrics.publish()
+                except Exception as e:
+                    error(f'{e}', self.notifier)
+                if self.agent is not None:
+                    ship_reports(self.agent)
+                if self.notifier:
+                    try:
+                        flush_notifier(self.notifier)
+                    except Exception as e:
+                        error(f'Could not send notifications: {e}')
+                try:
+                    end_run(self.config)
+                except Exception as e:
+                    error(f'Could not write the run summary: {e}')
+                self.wait(started)
+        finally:
+            self.finish_following()
+            self.stop_following()
+            self.stop_metrics_server()
+            self.handles.close()
+            if self.agent is not None:
+                self.agent.close()
+        info('Daemon stopped')
+
+# Collects the reports of the agents of a fleet and answers fleet queries, see fward_fleet.py.
+# Alerts of the agents' devices are deduplicated by the store and sent through the notifier of the collector.
+# The store is saved and the alerts are sent every FWARD_COLLECTOR_SAVE_INTERVAL seconds.
+class FleetCollector:
+    def __init__(self, config, notifier):
+        self.config = config
+        self.notifier = notifier
+        self.store = FleetStore(config.collector_store_file)
+        self.stale_after = config.collector_stale_after
+        self.alerts = []
+        self.lock = threading.Lock()
+        self.running = True
+
+    def request_stop(self, signum, frame):
+        self.running = False
+
+    # Called from the server threads, the alerts are sent from the main thread.
+    def alert(self, alerts):
+        with self.lock:
+            self.alerts.extend(alerts)
+
+    def send_alerts(self):
+        with self.lock:
+            alerts, self.alerts = self.alerts, []
+        for host, message in alerts:
+            error(message, self.notifier, host)
+        if self.notifier:
+            try:
+                self.notifier.flush()
+            except Exception as e:
+                error(f'Could not send notifications: {e}')
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        server = start_fleet_server(self, self.config.collector_address, self.config.collector_port, self.config.collector_socket)
+        where = self.config.collector_socket or f'{self.config.collector_address}:{self.config.collector_port}'
+        info(f'Collecting fleet reports on {where}')
+        try:
+            while self.running:
+                deadline = time.monotonic() + self.config.collector_save_interval
+                while self.running and time.monotonic() < deadline:
+                    time.sleep(min(1, max(0, deadline - time.monotonic())))
+                self.store.save()
+                self.send_alerts()
+        finally:
+            server.shutdown()
+            server.server_close()
+            self.store.save()
+        info('Collector stopped')
+
 # Main function
 if __name__ == '__main__':
     info("Starting Btrfs Monitor v0.2")
+    notifier = None
+    locked = False
+    config = None
+    profiler = None
     try:
-        data_dir = get_environment_variable('FWARD_DATA_DIR', '/var/fward/data')
-        create_directory(data_dir)
-        check_write_permission(data_dir)
-        config_dir = get_environment_variable('FWARD_CONFIG_DIR', '/var/fward/config')
-        create_directory(config_dir)
-        check_write_permission(config_dir)
-        
-        cache_file_name = get_environment_variable('FWARD_CACHE_NAME', 'devices.cache')
-        cache_file = os.path.join(data_dir, cache_file_name)
-        info(f'Cache file: {cache_file}')
-        
-        notifier_config_name = get_environment_variable('FWARD_NOTIFIER_FILE', 'notifier.conf')
-        notifier_config = os.path.join(config_dir, notifier_config_name)
-        
-        notifier = create_apprise_object(notifier_config)
-        if notifier:
-            info(f'Notifier config: {notifier_config}')
-        else:
-            error(f'Could not find notifier config file: {notifier_config}, notifications will not be sent.')
-        
-        lock_file()
-        
-        # If the program arguments contain --test-notify, we send a test notification.
+        config = FwardConfig()
+        info(f'Cache file: {config.cache_file}')
+        notifier = load_notifier(config)
+
+        # Only reads the history, so it does not need the lock and can run next to the daemon.
+        if '--rates' in sys.argv:
+            report_rates(config, notifier)
+            sys.exit(0)
+
+        # Sent right away, without the digest and the cooldown. It doesn't touch the stats, so it needs no lock either.
         if '--test-notify' in sys.argv:
-            if notifier:
-                notifier.notify('This is a test notification')
+            apobj = notifier.apobj if notifier else None
+            if apobj:
+                apobj.notify('This is a test notification')
             else:
                 print('No notifier found')
             sys.exit(0)
         
-        mounts = get_all_btrfs_mounts()
-        # Print out all the mounts and devices.
-        if '--debug' in sys.argv:
-            for mount in mounts:
-                print(f'Mount point: {mount.mount_point}')
-                for device in mount.devices:
-                    print(f'    Device: {device.device} UUID: {device.uuid}')
-                    print(f'        Write errors: {device.stats.write_errors}')
-                    print(f'        Read errors: {device.stats.read_errors}')
-                    print(f'        Flush errors: {device.stats.flush_errors}')
-                    print(f'        Corruption errors: {device.stats.corruption_errors}')
-                    print(f'        Generation errors: {device.stats.generation_errors}')
-        # If there are no mounts, say so
-        if not mounts:
-            warn('No btrfs mounts found', notifier)
-            sys.exit(0)
-        
-        # Read old cache if it exists
-        old_mounts = read_cache_file(cache_file)    
-        
-        write_cache_file(cache_file, mounts)
-        
-        if old_mounts is None:
-            warn('No old cache found', notifier)
+        # Collects from other hosts, it does not touch the local filesystems and needs no lock.
+        if '--collector' in sys.argv:
+            FleetCollector(config, notifier).run()
             sys.exit(0)
-        else:
-            # Compare the old and new mounts
-            changes = compare_mounts(old_mounts, mounts)
-            if changes.added_mounts:
-                for mount in changes.added_mounts:
-                    info(f'Added mount: {mount.mount_point}', notifier)
-            if changes.removed_mounts:
-                for mount in changes.removed_mounts:
-                    warn(f'Removed mount: {mount.mount_point}', notifier)
-            if changes.added_devices:
-                for mount, device in changes.added_devices:
-                    info(f'Added device: {device.device} to {mount.mount_point}', notifier)
-            if changes.removed_devices:
-                for mount, device in changes.removed_devices:
-                    warn(f'Removed device: {device.device} from {mount.mount_point}', notifier)
-                    
-            if changes.changed_devices:
-                for mount, new_device, old_device in changes.changed_devices:
-                    error(f'Changed stats of device: {new_device.device} in {mount.mount_point}\nWrite errors: {old_device.stats.write_errors} -> {new_device.stats.write_errors}\nRead errors: {old_device.stats.read_errors} -> {new_device.stats.read_errors}\nFlush errors: {old_device.stats.flush_errors} -> {new_device.stats.flush_errors}\nCorruption errors: {old_device.stats.corruption_errors} -> {new_device.stats.corruption_errors}\nGeneration errors: {old_device.stats.generation_errors} -> {new_device.stats.generation_errors}', notifier)
-            # if none of the above are true, we are done.
-            if not changes.added_mounts and not changes.removed_mounts and not changes.added_devices and not changes.removed_devices and not changes.changed_devices:
-                info('No changes in mounts or devices.')
-            else:
-                info('Changes found in mounts or devices.', notifier)
 
-        # Now we are going to check for broken files.
-        FWARD_LAST_CHECK_FILE = get_environment_variable('FWARD_LAST_CHECK_FILE', os.path.join(data_dir, 'last_check'))
+        lock_file(notifier)
+        locked = True
 
-        # Get the current date
-        current_date = int(time.time())
+        # cProfile adds a lot of overhead, it only runs when asked for.
+        if '--profile' in sys.argv and config.profile_stats_file:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
 
-        # Check if the last check date file exists
-        if os.path.exists(FWARD_LAST_CHECK_FILE):
-            with open(FWARD_LAST_CHECK_FILE, 'r') as file:
-                last_check_date = int(file.read().strip())
+        if '--daemon' in sys.argv:
+            FwardDaemon(config, notifier, follow='--follow' in sys.argv).run()
         else:
-            # If the file doesn't exist, initialize it with 1/1/1970
-            last_check_date = 0
-
-        # Convert dates to readable format for journalctl
-        last_check_date_readable = datetime.fromtimestamp(last_check_date).strftime('%Y-%m-%d %H:%M:%S')
-        current_date_readable = datetime.fromtimestamp(current_date).strftime('%Y-%m-%d %H:%M:%S')
-
-        # Store the current date for the next run
-        with open(FWARD_LAST_CHECK_FILE, 'w') as file:
-            file.write(str(current_date))
-            
-        # Run the journalctl command for the time period
-        broken_files = get_broken_files(mounts, last_check_date_readable, current_date_readable)
-        if broken_files:
-            list = '\n'.join(broken_files)
-            raise Exception(f'Broken files detected:\n{list}')
-            
-        unlock_file()
-        info("Nothing broken detected")
-        sys.exit(0)
+            begin_run(config)
+            metrics = FwardMetrics(config.metrics_textfile) if config.metrics_textfile else None
+            with profile_phase('cache_read'):
+                old_mounts = read_cache_file(config.cache_file)
+            agent = load_agent(config)
+            try:
+                run_check(config, notifier, old_mounts, metrics=metrics, agent=agent)
+                if metrics is not None:
+                    with profile_phase('metrics'):
+                        metrics.publish()
+            finally:
+                if agent is not None:
+                    ship_reports(agent)
+                    agent.close()
     except Exception as e:
-        unlock_file()
         error(f'{e}', notifier)
-        sys.exit(0)
\ No newline at end of file
+    finally:
+        # Always release the lock, also on the early exits.
+        if locked:
+            unlock_file()
+        # Send what the run collected as one digest.
+        if notifier:
+            flush_notifier(notifier)
+        if config is not None:
+            end_run(config)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(config.profile_stats_file)
+            info(f'Wrote profile stats to {config.profile_stats_file}')
+    sys.exit(0)
@@ -0,0 +1,50 @@
+from fward_mounts import MountTable, find_btrfs_filesystems
+from fward_journal import JournalReader
+from fward_kmsg import follow_kernel_log
+from fward_resolve import resolve_filesystem
+from fward_scrub import read_device_scrubs
+from fward_space import read_filesystem_space
+from fward_subvolumes import read_subvolume_status
+
+# Everything fward reads from the system goes through a backend:
+#   mount_table()        the btrfs filesystems, kept up to date, for the daemon
+#   find_filesystems()   the btrfs filesystems, read once, as lists of mount points
+#   open_filesystem()    an object with devices(), dev_info(devid) and dev_stats(devid), closed with __exit__
+#   scrub_status()       a DeviceScrub per device of an opened filesystem
+#   space_status()       the FilesystemSpace of an opened filesystem, the chunk tree walk cached in a SpaceCache
+#   subvolume_status()   the SubvolumeStatus of an opened filesystem, read through a SubvolumeCache
+#   journal()            an object with lines(), lines_read and commit(), like JournalReader
+#   kernel_log()         an object with poll(timeout), source and close(), the new kernel log lines like KmsgFollower
+#   resolve_filesystem() the paths of the (kind, number) references of one filesystem
+# See fward_simulate.py for a backend without btrfs.
+
+# The real system: mountinfo, the btrfs ioctls, journalctl and the btrfs CLI.
+class BtrfsBackend:
+    def mount_table(self):
+        return MountTable()
+
+    def find_filesystems(self):
+        return find_btrfs_filesystems()
+
+    # btrfs is imported on first use, runs that don't scan don't need it.
+    def open_filesystem(self, mount_point):
+        import btrfs
+        return btrfs.FileSystem(mount_point)
+
+    def scrub_status(self, fs, status_dir):
+        return read_device_scrubs(fs, status_dir)
+
+    def space_status(self, fs, cache):
+        return read_filesystem_space(fs, cache)
+
+    def subvolume_status(self, fs, cache):
+        return read_subvolume_status(fs, cache)
+
+    def journal(self, cursor_file, grep, backlog, since=None):
+        return JournalReader(cursor_file, grep, backlog, since)
+
+    def kernel_log(self, grep):
+        return follow_kernel_log(grep)
+
+    def resolve_filesystem(self, mount_point, references, handles=None, cache=None):
+        return resolve_filesystem(mount_point, references, handles, cache)
@@ -0,0 +1,300 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import subprocess
+import contextlib
+import yaml
+from fward import *
+from fward_simulate import SimulatedBtrfs
+
+# Benchmarks for fward, using synthetic data so no btrfs pools are needed.
+# Run all of them with: python fward_bench.py
+# Or pick some: python fward_bench.py compare
+# Add --json results.json to also store the results, e.g. to compare releases.
+
+DEVICES_PER_MOUNT = 24
+
+# Builds a snapshot of device_count devices, spread over mounts of DEVICES_PER_MOUNT devices.
+def make_snapshot(device_count, seed=0):
+    rng = random.Random(seed)
+    mounts = []
+    for index in range(device_count):
+        if index % DEVICES_PER_MOUNT == 0:
+            mounts.append(BtrfsMountPoint(f'/mnt/pool{len(mounts)}', list()))
+        stats = BtrfsDeviceStats(0, 0, 0, rng.randint(0, 3), 0)
+        mounts[-1].devices.append(BtrfsDevice(f'/dev/sd{index}', f'00000000-0000-0000-0000-{index:012d}', stats))
+    return mounts
+
+# Derives the next snapshot: bumps the counters of about 1% of the devices,
+# drops the last mount and adds a device to the first one.
+def mutate_snapshot(mounts, seed=1):
+    rng = random.Random(seed)
+    new_mounts = []
+    for mount in mounts[:-1] if len(mounts) > 1 else mounts:
+        new_mount = BtrfsMountPoint(mount.mount_point, list())
+        for device in mount.devices:
+            stats = BtrfsDeviceStats(*device.stats.counters())
+            if rng.random() < 0.01:
+                stats.corruption_errors += 1
+            new_mount.devices.append(BtrfsDevice(device.device, device.uuid, stats))
+        new_mounts.append(new_mount)
+    new_mounts[0].devices.append(BtrfsDevice('/dev/new', 'ffffffff-0000-0000-0000-000000000000', BtrfsDeviceStats(0, 0, 0, 0, 0)))
+    return new_mounts
+
+# Returns the best wall time in seconds out of repeat calls.
+def best_of(func, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# Every result printed, for --json.
+RESULTS = []
+
+def print_result(name, size, seconds):
+    RESULTS.append({'name': name, 'size': size, 'seconds': seconds})
+    print(f'{name:<32} {size:>10} {seconds * 1000:>12.3f} ms')
+
+# The nested comprehension version of compare_mounts that shipped up to v0.2, kept as a reference.
+def legacy_compare_mounts(old_mounts, new_mounts):
+    added_mounts = [mount for mount in new_mounts if mount.mount_point not in [old_mount.mount_point for old_mount in old_mounts]]
+    removed_mounts = [mount for mount in old_mounts if mount.mount_point not in [new_mount.mount_point for new_mount in new_mounts]]
+    mount_added_devices = [(mount, device) for mount in new_mounts for device in mount.devices if mount.mount_point in [old_mount.mount_point for old_mount in old_mounts] and device.uuid not in [old_device.uuid for old_mount in old_mounts for old_device in old_mount.devices]]
+    mount_removed_devices = [(mount, device) for mount in old_mounts for device in mount.devices if mount.mount_point in [new_mount.mount_point for new_mount in new_mounts] and device.uuid not in [new_device.uuid for new_mount in new_mounts for new_device in new_mount.devices]]
+    mount_changed_devices = []
+    for new_mount in new_mounts:
+        for new_device in new_mount.devices:
+            for old_mount in old_mounts:
+                if new_mount.mount_point == old_mount.mount_point:
+                    for old_device in old_mount.devices:
+                        if new_device.uuid == old_device.uuid:
+                            if new_device.stats.counters() != old_device.stats.counters():
+                                mount_changed_devices.append((new_mount, new_device, old_device))
+    return BtrfsMountChanges(added_mounts, removed_mounts, mount_added_devices, mount_removed_devices, mount_changed_devices)
+
+# The legacy version is cubic, past this size it takes minutes.
+LEGACY_MAX_DEVICES = 1000
+
+def bench_compare():
+    print(f'{"benchmark":<32} {"devices":>10} {"best":>15}')
+    for size in (10, 100, 1000, 10000):
+        old_mounts = make_snapshot(size)
+        new_mounts = mutate_snapshot(old_mounts)
+        print_result('compare_mounts', size, best_of(lambda: compare_mounts(old_mounts, new_mounts)))
+        if size <= LEGACY_MAX_DEVICES:
+            print_result('compare_mounts (legacy)', size, best_of(lambda: legacy_compare_mounts(old_mounts, new_mounts), repeat=1))
+
+# The YAMLObject models and cache functions that shipped up to v0.2, kept as a reference.
+class LegacyBtrfsDeviceStats(yaml.YAMLObject):
+    yaml_tag = "!BtrfsDeviceStats"
+    yaml_loader = yaml.SafeLoader
+    def __init__(self, write_errors, read_errors, flush_errors, corruption_errors, generation_errors):
+        self.write_errors = write_errors
+        self.read_errors = read_errors
+        self.flush_errors = flush_errors
+        self.corruption_errors = corruption_errors
+        self.generation_errors = generation_errors
+
+class LegacyBtrfsDevice(yaml.YAMLObject):
+    yaml_tag = "!BtrfsDevice"
+    yaml_loader = yaml.SafeLoader
+    def __init__(self, device, uuid, stats):
+        self.device = device
+        self.uuid = uuid
+        self.stats = stats
+
+class LegacyBtrfsMountPoint(yaml.YAMLObject):
+    yaml_tag = "!BtrfsMountPoint"
+    yaml_loader = yaml.SafeLoader
+    def __init__(self, mount_point, devices):
+        self.mount_point = mount_point
+        self.devices = devices
+
+def to_legacy_snapshot(mounts):
+    return [LegacyBtrfsMountPoint(mount.mount_point, [LegacyBtrfsDevice(device.device, device.uuid, LegacyBtrfsDeviceStats(*device.stats.counters())) for device in mount.devices]) for mount in mounts]
+
+def legacy_read_cache_file(cache_file):
+    with open(cache_file, 'r') as f:
+        return yaml.safe_load(f)
+
+def legacy_write_cache_file(cache_file, data):
+    with open(cache_file, 'w') as f:
+        yaml.dump(data, f)
+
+# YAML in pure Python is slow, past this size a single store takes seconds.
+LEGACY_CACHE_MAX_DEVICES = 1000
+
+def bench_cache():
+    print(f'{"benchmark":<32} {"devices":>10} {"best":>15}')
+    with tempfile.TemporaryDirectory() as directory:
+        cache_file = os.path.join(directory, 'devices.cache')
+        for size in (10, 100, 1000, 10000):
+            mounts = make_snapshot(size)
+            print_result('write_cache_file', size, best_of(lambda: write_cache_file(cache_file, mounts)))
+            print_result('read_cache_file', size, best_of(lambda: read_cache_file(cache_file)))
+            print_result('write_cache_file (unchanged)', size, best_of(lambda: write_cache_file(cache_file, mounts, mounts)))
+            print(f'{"size on disk":<32} {size:>10} {os.path.getsize(cache_file):>12} B')
+            if size <= LEGACY_CACHE_MAX_DEVICES:
+                legacy_mounts = to_legacy_snapshot(mounts)
+                print_result('write_cache_file (legacy)', size, best_of(lambda: legacy_write_cache_file(cache_file, legacy_mounts), repeat=1))
+                print_result('read_cache_file (legacy)', size, best_of(lambda: legacy_read_cache_file(cache_file), repeat=1))
+                print(f'{"size on disk (legacy)":<32} {size:>10} {os.path.getsize(cache_file):>12} B')
+                # Also the one-time conversion of the legacy file.
+                print_result('read_cache_file (migration)', size, best_of(lambda: read_cache_file(cache_file), repeat=1))
+
+# Builds the history a device has after a year of one-minute samples, without appending them one by one.
+def make_year_of_history(history_dir, uuid, now):
+    history = DeviceHistory(history_dir, uuid, 24, 365)
+    history.hourly.replace([(now - hour * 3600 - 86400, 0, 0, 0, (8760 - hour) // 24, 0) for hour in range(8760, 0, -1)])
+    history.raw.replace([(now - minute * 60, 0, 0, 0, 365, 0) for minute in range(1440, 0, -1)])
+    return history
+
+def bench_history():
+    print(f'{"benchmark":<32} {"devices":>10} {"best":>15}')
+    with tempfile.TemporaryDirectory() as directory:
+        now = int(time.time())
+        for size in (10, 100, 1000):
+            mounts = make_snapshot(size)
+            for mount in mounts:
+                for device in mount.devices:
+                    make_year_of_history(directory, device.uuid, now)
+            timestamps = iter(range(now + 60, now + 60 * 100, 60))
+            print_result('record_history', size, best_of(lambda: record_history(directory, mounts, next(timestamps), 24, 365)))
+            uuid = mounts[0].devices[0].uuid
+            print_result('error_rates (one device)', size, best_of(lambda: error_rates(directory, uuid, now, 24, 365)))
+        print(f'{"size on disk per device":<32} {"":>10} {os.path.getsize(os.path.join(directory, uuid + ".raw")) + os.path.getsize(os.path.join(directory, uuid + ".hourly")):>12} B')
+
+# Every kernel message format the parser knows, and a line it has to skip.
+KERNEL_LOG_FORMATS = (
+    'BTRFS warning (device sd{n}): csum failed root 5 ino {ino} off {offset} csum 0x8941f998 expected csum 0x1e1f4d5b mirror 1',
+    'BTRFS warning (device sd{n}: state EA): csum failed root 256 ino {ino} off {offset} csum 0x8941f998 expected csum 0x1e1f4d5b mirror 2',
+    'BTRFS warning (device sd{n}): checksum error at logical {logical} on dev /dev/sd{n}, physical {logical}, root 5, inode {ino}, offset {offset}, length 4096, links 1 (path: data/file{ino})',
+    'BTRFS warning (device sd{n}): checksum error at logical {logical} on dev /dev/sd{n}, physical {logical}: metadata leaf (level 0) in tree 5',
+    'BTRFS error (device sd{n}): unable to fixup (regular) error at logical {logical} on dev /dev/sd{n}',
+    'BTRFS error (device sd{n}): fixed up error at logical {logical} on dev /dev/sd{n}',
+    'BTRFS info (device sd{n}): read error corrected: ino {ino} off {offset} (dev /dev/sd{n} sector 2048)',
+    'BTRFS info (device sd{n}): balance: ended with status: 0',
+)
+
+# A kernel log of size lines, repeating distinct different lines as a burst of errors does.
+def make_kernel_log(size, distinct, seed=0):
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(distinct):
+        ino = 257 + rng.randrange(100000)
+        offset = rng.randrange(256) * 4096
+        pool.append(rng.choice(KERNEL_LOG_FORMATS).format(n=rng.randrange(24), ino=ino, offset=offset, logical=ino * (1 << 20) + offset))
+    return [pool[rng.randrange(distinct)] for _ in range(size)]
+
+# The three searches per line of v0.2 and older, kept as a reference.
+def legacy_find_broken_references(lines):
+    import re
+    for line in lines:
+        device = re.search(r'device (\w+)', line)
+        if not device:
+            continue
+        ino = re.search(r'ino (\d+)', line)
+        if ino:
+            yield ('inode', device.group(1), ino.group(1))
+        logical = re.search(r'logical (\d+)', line)
+        if logical:
+            yield ('logical', device.group(1), logical.group(1))
+
+# Parsing the kernel warnings, up to a few million lines, as lines per second next to the time.
+def bench_parse():
+    print(f'{"benchmark":<32} {"lines":>10} {"best":>15}')
+    for size in (10000, 100000, 1000000):
+        backend = SimulatedBtrfs(filesystems=25, warnings=size)
+        lines = list(backend.journal(None, None, size).lines())
+        print_result('find_broken_references', size, best_of(lambda: set(find_broken_references(lines)), repeat=3))
+    for size in (10000, 100000, 1000000, 5000000):
+        lines = make_kernel_log(size, min(size, 100000))
+        seconds = best_of(lambda: list(unique_messages(parse_messages(unique_lines(lines)))), repeat=3)
+        print_result('unique_messages (all formats)', size, seconds)
+        print(f'{"  lines per second":<32} {"":>10} {size / seconds:>12.0f}')
+        if size <= 1000000:
+            print_result('  every line parsed', size, best_of(lambda: list(unique_messages(parse_messages(lines))), repeat=3))
+            print_result('  v0.2 three searches per line', size, best_of(lambda: set(legacy_find_broken_references(lines)), repeat=3))
+
+# A whole run of the one-shot check against the simulated backend: scan, cache, history, diff, journal and resolving.
+# Between runs the counters of about 0.1% of the devices go up and 1,000 warnings are logged.
+def bench_run():
+    print(f'{"benchmark":<32} {"devices":>10} {"best":>15}')
+    for size in (10, 100, 1000, 10000):
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ['FWARD_DATA_DIR'] = os.path.join(directory, 'data')
+            os.environ['FWARD_CONFIG_DIR'] = os.path.join(directory, 'config')
+            config = FwardConfig()
+            backend = SimulatedBtrfs(filesystems=max(1, size // 4), devices_per_filesystem=min(size, 4), warnings=10000, warnings_per_step=1000, error_rate=0.001)
+            state = {'mounts': None}
+            def run():
+                backend.advance()
+                state['mounts'] = run_check(config, None, state['mounts'], backend=backend)
+            # Leave out the messages, only the work is measured.
+            with contextlib.redirect_stdout(io.StringIO()):
+                run()
+                seconds = best_of(run)
+            print_result('run_check', size, seconds)
+
+# Startup: importing fward in a new interpreter, next to an interpreter that imports nothing.
+# Also lists what fward imports, slowest first, as python -X importtime reports it.
+def bench_startup():
+    print(f'{"benchmark":<32} {"":>10} {"best":>15}')
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def python(*args):
+        return subprocess.run([sys.executable, *args], cwd=directory, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    print_result('python -c pass', '-', best_of(lambda: python('-c', 'pass'), repeat=10))
+    print_result('python -c "import fward"', '-', best_of(lambda: python('-c', 'import fward'), repeat=10))
+    # Lines look like: import time:       self [us] |  cumulative | imported package
+    imports = []
+    inside = False
+    for line in reversed(python('-X', 'importtime', '-c', 'import fward').stderr.splitlines()):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if name.strip() == 'fward':
+            inside = True
+        elif inside:
+            # importtime lists what fward imports right before it, one level deeper.
+            if depth == 0:
+                break
+            if depth == 1:
+                imports.append((int(cumulative) / 1e6, name.strip()))
+    for seconds, name in sorted(imports, reverse=True):
+        print_result(f'  import {name}', '-', seconds)
+
+BENCHMARKS = {
+    'compare': bench_compare,
+    'cache': bench_cache,
+    'history': bench_history,
+    'parse': bench_parse,
+    'run': bench_run,
+    'startup': bench_startup,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    json_file = None
+    if '--json' in names:
+        index = names.index('--json')
+        json_file = names[index + 1]
+        del names[index:index + 2]
+    names = names or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f'Unknown benchmark: {name}, choose from: {", ".join(BENCHMARKS)}')
+            sys.exit(1)
+    for name in names:
+        BENCHMARKS[name]()
+    if json_file:
+        with open(json_file, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': RESULTS}, f, indent=2)
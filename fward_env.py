@@ -1,69 +1,7 @@
 import os
 import sys
-import apprise
-from apprise import NotifyType
-from dataclasses import dataclass
-
-global notifier
-
-def create_apprise_object(configfile):
-    try:
-        apobj = apprise.Apprise()
-        # Read the configuration file
-        # And add on split lines.
-        with open(configfile, 'r') as f:
-            lines = f.readlines()
-        for line in lines:
-            apobj.add(line.strip())
-        return apobj
-    except Exception as e:
-        print(f'Failed to create apprise object: {e}')
-        return None
-
-# Function that logs a message.
-# It will also do a syslog if it is available.
-def info(message, notifier=None):
-    print("[FWARD][INFO] " + message)
-    # Try to log to syslog
-    try:
-        import syslog
-        syslog.syslog(syslog.LOG_INFO, message)
-    except:
-        pass
-    if notifier:
-        notifier.notify(
-                body=message,
-                title='[LOG] Btrfs Monitor',
-                notify_type=NotifyType.INFO
-            )
-def error(message, notifier=None):
-    print("[FWARD][ERROR] " + message)
-    # Try to log to syslog
-    try:
-        import syslog
-        syslog.syslog(syslog.LOG_ERR, message)
-    except:
-        pass
-    if notifier:
-        notifier.notify(
-                body=message,
-                title='[ERROR] Btrfs Monitor',
-                notify_type=NotifyType.FAILURE
-            )
-def warn(message, notifier=None):
-    print("[FWARD][WARN] " + message)
-    # Try to log to syslog
-    try:
-        import syslog
-        syslog.syslog(syslog.LOG_WARNING, message)
-    except:
-        pass
-    if notifier:
-        notifier.notify(
-                body=message,
-                title='[WARNING] Btrfs Monitor',
-                notify_type=NotifyType.WARNING
-            )
+import json
+import threading
 
 # Function that tries to create a directory if it does not exist.
 # If it does exist, it does nothing.
@@ -96,4 +34,60 @@ def check_write_permission(directory):
         os.remove(os.path.join(directory, 'write.lock'))
     except Exception as e:
         print(f'Failed to write to directory {directory}: {e}')
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
+
+# Writes data to a temporary file first, syncs it and then renames it over the target.
+# A crash never leaves a half written file behind, readers see either the old or the new one.
+def write_file_atomic(path, data):
+    temp_file = path + '.tmp'
+    with open(temp_file, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+
+# A JSON state file with what is cached per filesystem and when each alert was last sent:
+# {"version": version, "filesystems": {fsid: ...}, "alerts": {key: timestamp}}
+# A file of another version is started over. Shared by the threads of a scan, so access is locked.
+class FilesystemState:
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        self.filesystems = {}
+        self.alerts = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return
+        if not isinstance(data, dict) or data.get('version') != self.version:
+            return
+        self.filesystems = data['filesystems']
+        self.alerts = data['alerts']
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({'version': self.version, 'filesystems': self.filesystems, 'alerts': self.alerts}, separators=(',', ':'))
+        write_file_atomic(self.path, data)
+
+    # Returns the messages of the (key, message) problems of a filesystem that are due: new ones, and those last
+    # sent a day ago. The alerts of the filesystem that are no longer a problem are forgotten, so they are sent
+    # right away should they come back.
+    def due_alerts(self, mount_point, problems, now):
+        prefix = f'{mount_point}:'
+        keys = {prefix + key for key, _ in problems}
+        due = []
+        with self.lock:
+            for key in [key for key in self.alerts if key.startswith(prefix) and key not in keys]:
+                del self.alerts[key]
+            for key, message in problems:
+                if now - self.alerts.get(prefix + key, 0) >= 86400:
+                    self.alerts[prefix + key] = now
+                    due.append(message)
+        return due
@@ -0,0 +1,409 @@
+import os
+import json
+import time
+import socket
+import threading
+from urllib.parse import urlsplit, parse_qs
+from fward_env import write_file_atomic
+from fward_snapshot import encode_snapshot
+
+# Fleet mode: agents ship what their runs found to one collector, which keeps the state of every host.
+# A report is a JSON object {"host", "seq", "at"} with either the full snapshot under "mounts", in the
+# encoding of the cache file, or the changes of a run under "changes". A run without changes sends none.
+# The agent keeps its reports in a spool file until the collector accepted them, so nothing is lost while
+# it is unreachable, and sends them in one batch over a connection it keeps open.
+# The collector answers with need_full when it is missing reports of the host, the agent then sends a snapshot.
+
+FLEET_STORE_VERSION = 1
+AGENT_STATE_VERSION = 1
+
+REPORT_PATH = '/fleet/report'
+
+# The counters, in the order of BtrfsDeviceStats.counters(), as named in queries.
+COUNTER_NAMES = ('write', 'read', 'flush', 'corruption', 'generation')
+
+def encode_device(mount, device):
+    return [mount.mount_point, device.device, device.uuid, *device.stats.counters()]
+
+# Only what is not empty, most runs change nothing.
+def encode_changes(changes):
+    encoded = {
+        'added_mounts': encode_snapshot(changes.added_mounts),
+        'removed_mounts': [mount.mount_point for mount in changes.removed_mounts],
+        'added_devices': [encode_device(mount, device) for mount, device in changes.added_devices],
+        'removed_devices': [[mount.mount_point, device.uuid] for mount, device in changes.removed_devices],
+        'changed_devices': [encode_device(mount, device) for mount, device, _ in changes.changed_devices],
+    }
+    return {key: value for key, value in encoded.items() if value}
+
+# http.client is only imported by agents that ship.
+def connect(url, timeout):
+    import http.client
+    parts = urlsplit(url)
+    if parts.scheme == 'unix':
+
+        class UnixHTTPConnection(http.client.HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(parts.path)
+
+        return UnixHTTPConnection('localhost', timeout=timeout)
+    if parts.scheme == 'https':
+        return http.client.HTTPSConnection(parts.hostname, parts.port, timeout=timeout)
+    return http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+
+# Ships the reports of this host to the collector at url, http://host:port or unix:///path/to/socket.
+class FleetAgent:
+    def __init__(self, url, host, spool_file, state_file, spool_max_bytes, timeout=10):
+        self.url = url
+        self.host = host
+        self.spool_file = spool_file
+        self.state_file = state_file
+        self.spool_max_bytes = spool_max_bytes
+        self.timeout = timeout
+        self.connection = None
+        self.mounts = None
+        self.seq, self.need_full = self.load_state()
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return 0, True
+        try:
+            with open(self.state_file, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return 0, True
+        if data.get('version') != AGENT_STATE_VERSION:
+            return 0, True
+        return data['seq'], data['need_full']
+
+    def save_state(self):
+        write_file_atomic(self.state_file, json.dumps({'version': AGENT_STATE_VERSION, 'seq': self.seq, 'need_full': self.need_full}))
+
+    # Spools the report of a run. Without changes, e.g. on the first run, the full snapshot is sent.
+    # A snapshot makes everything spooled before it obsolete, so it replaces the spool, as it does
+    # when the collector has been unreachable for so long that the spool grew past its limit.
+    def record(self, mounts, changes=None):
+        self.mounts = mounts
+        too_big = os.path.exists(self.spool_file) and os.path.getsize(self.spool_file) > self.spool_max_bytes
+        if changes is None or self.need_full or too_big:
+            self.spool({'mounts': encode_snapshot(mounts)}, replace=True)
+            self.need_full = False
+        else:
+            encoded = encode_changes(changes)
+            if encoded:
+                self.spool({'changes': encoded})
+        self.save_state()
+
+    def spool(self, content, replace=False):
+        self.seq += 1
+        line = json.dumps({'host': self.host, 'seq': self.seq, 'at': time.time(), **content}, separators=(',', ':')) + '\n'
+        if replace:
+            write_file_atomic(self.spool_file, line)
+            return
+        with open(self.spool_file, 'a') as f:
+            f.write(line)
+
+    def spooled(self):
+        if not os.path.exists(self.spool_file):
+            return []
+        reports = []
+        with open(self.spool_file, 'r') as f:
+            for line in f:
+                try:
+                    reports.append(json.loads(line))
+                except ValueError:
+                    # Cut off by a crash, the collector asks for a snapshot when it notices the gap.
+                    continue
+        return reports
+
+    # Sends the spooled reports in one batch, and also when there are none so the collector knows the host is alive.
+    # Returns the number of reports sent. Raises OSError when the collector could not be reached, the reports stay spooled.
+    def ship(self):
+        reports = self.spooled()
+        response = self.post({'host': self.host, 'reports': reports})
+        if os.path.exists(self.spool_file):
+            os.remove(self.spool_file)
+        if response.get('need_full') and self.mounts is not None:
+            self.need_full = True
+            self.record(self.mounts)
+            return len(reports) + self.ship()
+        if response.get('need_full'):
+            self.need_full = True
+            self.save_state()
+        return len(reports)
+
+    # Posts over the open connection. A connection the collector closed in the meantime is opened again once.
+    def post(self, batch):
+        body = json.dumps(batch, separators=(',', ':')).encode()
+        headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = connect(self.url, self.timeout)
+            try:
+                self.connection.request('POST', REPORT_PATH, body, headers)
+                response = self.connection.getresponse()
+                data = response.read()
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+                continue
+            except Exception as e:
+                self.close()
+                raise OSError(f'Bad response from the collector: {e}')
+            if response.status != 200:
+                raise OSError(f'The collector answered {response.status} {response.reason}')
+            try:
+                answer = json.loads(data)
+            except ValueError:
+                answer = None
+            if not isinstance(answer, dict):
+                self.close()
+                raise OSError(f'Bad response from the collector: {data[:200]!r}')
+            return answer
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+# The last known state of a device in the fleet.
+# increased_at has per counter when it last went up, alerted the value it was last alerted at.
+class FleetDevice:
+    __slots__ = ('host', 'mount_point', 'device', 'uuid', 'counters', 'increased_at', 'alerted')
+    def __init__(self, host, mount_point, device, uuid, counters, increased_at=None, alerted=None):
+        self.host = host
+        self.mount_point = mount_point
+        self.device = device
+        self.uuid = uuid
+        self.counters = counters
+        self.increased_at = increased_at or [0] * len(COUNTER_NAMES)
+        self.alerted = alerted or list(counters)
+
+    def encode(self):
+        return [self.mount_point, self.device, self.uuid, self.counters, self.increased_at, self.alerted]
+
+    def describe(self):
+        return {
+            'host': self.host, 'mount_point': self.mount_point, 'device': self.device, 'uuid': self.uuid,
+            'errors': dict(zip(COUNTER_NAMES, self.counters)),
+            'increased_at': dict(zip(COUNTER_NAMES, self.increased_at)),
+        }
+
+class FleetHost:
+    __slots__ = ('seq', 'last_seen', 'devices')
+    def __init__(self, seq=0, last_seen=0):
+        self.seq = seq
+        self.last_seen = last_seen
+        # By (mount point, uuid).
+        self.devices = {}
+
+# The state of every host, merged from their reports, in memory and saved to store_file.
+# Next to the devices per host, the devices are indexed per counter by when it last went up,
+# so asking for the devices with rising errors only looks at the devices that ever had an increase.
+# Reports are applied in order of their seq, ones that were applied before are skipped,
+# so a batch that is sent again after a lost answer changes nothing and alerts nothing twice.
+class FleetStore:
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.hosts = {}
+        self.rising = [dict() for _ in COUNTER_NAMES]
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.store_file):
+            return
+        try:
+            with open(self.store_file, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return
+        if data.get('version') != FLEET_STORE_VERSION:
+            return
+        for name, host in data['hosts'].items():
+            state = self.hosts[name] = FleetHost(host['seq'], host['last_seen'])
+            for mount_point, device, uuid, counters, increased_at, alerted in host['devices']:
+                self.index(name, state, FleetDevice(name, mount_point, device, uuid, counters, increased_at, alerted))
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            hosts = {name: {'seq': host.seq, 'last_seen': host.last_seen, 'devices': [device.encode() for device in host.devices.values()]} for name, host in self.hosts.items()}
+            self.dirty = False
+        write_file_atomic(self.store_file, json.dumps({'version': FLEET_STORE_VERSION, 'hosts': hosts}, separators=(',', ':')))
+
+    def index(self, name, host, device):
+        key = (device.mount_point, device.uuid)
+        host.devices[key] = device
+        for counter, at in enumerate(device.increased_at):
+            if at:
+                self.rising[counter][(name, key)] = device
+
+    def unindex(self, name, host, key):
+        host.devices.pop(key, None)
+        for rising in self.rising:
+            rising.pop((name, key), None)
+
+    # Applies a batch of one host. Returns whether it needs a full snapshot, and the alerts as (host, message).
+    def apply(self, name, reports, now):
+        alerts = []
+        with self.lock:
+            host = self.hosts.get(name)
+            if host is None:
+                host = self.hosts[name] = FleetHost()
+            host.last_seen = now
+            self.dirty = True
+            for report in sorted(reports, key=lambda report: report['seq']):
+                if report['seq'] <= host.seq and 'mounts' not in report:
+                    continue
+                if 'mounts' in report:
+                    self.apply_snapshot(name, host, report['mounts'], now, alerts)
+                elif report['seq'] == host.seq + 1:
+                    self.apply_changes(name, host, report['changes'], now, alerts)
+                else:
+                    # A report went missing, nothing after it can be applied until a snapshot comes.
+                    return True, alerts
+                host.seq = report['seq']
+            return host.seq == 0, alerts
+
+    def apply_snapshot(self, name, host, mounts, now, alerts):
+        seen = set()
+        for mount_point, devices, *_ in mounts:
+            for device, uuid, *counters in devices:
+                self.update_device(name, host, mount_point, device, uuid, counters, now, alerts)
+                seen.add((mount_point, uuid))
+        for key in [key for key in host.devices if key not in seen]:
+            self.unindex(name, host, key)
+
+    def apply_changes(self, name, host, changes, now, alerts):
+        for mount_point, devices, *_ in changes.get('added_mounts', []):
+            for device, uuid, *counters in devices:
+                self.update_device(name, host, mount_point, device, uuid, counters, now, alerts)
+        removed = set(changes.get('removed_mounts', []))
+        for key in [key for key in host.devices if key[0] in removed]:
+            self.unindex(name, host, key)
+        for mount_point, uuid in changes.get('removed_devices', []):
+            self.unindex(name, host, (mount_point, uuid))
+        for mount_point, device, uuid, *counters in changes.get('added_devices', []) + changes.get('changed_devices', []):
+            self.update_device(name, host, mount_point, device, uuid, counters, now, alerts)
+
+    # A device is only alerted on when a counter goes past the value it was last alerted at.
+    # A device seen for the first time is taken as it is, its host already alerted on what it found.
+    def update_device(self, name, host, mount_point, device, uuid, counters, now, alerts):
+        known = host.devices.get((mount_point, uuid))
+        if known is None:
+            self.index(name, host, FleetDevice(name, mount_point, device, uuid, counters))
+            return
+        known.device = device
+        for counter, (old, new) in enumerate(zip(known.counters, counters)):
+            # Reset, e.g. with btrfs device stats -z, the next rise is alerted again.
+            if new < old:
+                known.alerted[counter] = new
+            if new > old:
+                known.increased_at[counter] = now
+                self.rising[counter][(name, (mount_point, uuid))] = known
+            if new > known.alerted[counter]:
+                alerts.append((name, f'{COUNTER_NAMES[counter].capitalize()} errors of device {device} ({uuid}) in {mount_point} on {name} went up to {new}'))
+                known.alerted[counter] = new
+        known.counters = counters
+
+    def host_list(self, now, stale_after):
+        with self.lock:
+            return [
+                {'host': name, 'seq': host.seq, 'last_seen': host.last_seen, 'stale': now - host.last_seen > stale_after,
+                 'mounts': len({mount_point for mount_point, _ in host.devices}), 'devices': len(host.devices)}
+                for name, host in sorted(self.hosts.items())
+            ]
+
+    # The devices of which the counter went up since the timestamp, newest first.
+    def rising_devices(self, counter, since, host=None):
+        with self.lock:
+            devices = [device for device in self.rising[counter].values() if device.increased_at[counter] >= since and (host is None or device.host == host)]
+            devices.sort(key=lambda device: -device.increased_at[counter])
+            return [device.describe() for device in devices]
+
+    def host_devices(self, host):
+        with self.lock:
+            state = self.hosts.get(host)
+            return [device.describe() for device in state.devices.values()] if state else []
+
+# Answers the agents and the fleet queries. Runs on the threads of the server, the store does the locking.
+#   POST /fleet/report                              a batch of reports of one host
+#   GET  /fleet/hosts                               every host, when it was last seen and whether that is too long ago
+#   GET  /fleet/devices?host=<host>                 the devices of a host
+#   GET  /fleet/devices?rising=<counter>&since=<s>  the devices of which the counter went up in the last s seconds
+def handle_fleet_request(collector, method, path, body):
+    parts = urlsplit(path)
+    query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+    now = time.time()
+    if method == 'POST' and parts.path == REPORT_PATH:
+        batch = json.loads(body)
+        need_full, alerts = collector.store.apply(batch['host'], batch['reports'], now)
+        collector.alert(alerts)
+        return 200, {'need_full': need_full}
+    if method == 'GET' and parts.path == '/fleet/hosts':
+        return 200, collector.store.host_list(now, collector.stale_after)
+    if method == 'GET' and parts.path == '/fleet/devices':
+        if 'rising' in query:
+            if query['rising'] not in COUNTER_NAMES:
+                return 400, {'error': f'rising must be one of {", ".join(COUNTER_NAMES)}'}
+            since = now - float(query.get('since', 86400))
+            return 200, collector.store.rising_devices(COUNTER_NAMES.index(query['rising']), since, query.get('host'))
+        if 'host' in query:
+            return 200, collector.store.host_devices(query['host'])
+        return 400, {'error': 'ask for rising=<counter> or host=<host>'}
+    return 404, {'error': 'not found'}
+
+# http.server is only imported here, only the collector serves the fleet.
+# With a socket path it listens on a Unix socket, otherwise on address and port.
+def start_fleet_server(collector, address, port, socket_path=None):
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class FleetHandler(BaseHTTPRequestHandler):
+        # Keeps the connection of an agent open between its runs.
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self, method):
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length) if length else b''
+            try:
+                status, result = handle_fleet_request(self.server.collector, method, self.path, body)
+            except (ValueError, KeyError, TypeError) as e:
+                status, result = 400, {'error': f'bad request: {e}'}
+            data = json.dumps(result).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.respond('GET')
+
+        def do_POST(self):
+            self.respond('POST')
+
+        # Hundreds of agents, every run, that is not worth a log line each.
+        def log_message(self, format, *args):
+            pass
+
+    if socket_path:
+
+        class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, FleetHandler)
+    else:
+        server = ThreadingHTTPServer((address, port), FleetHandler)
+        server.daemon_threads = True
+    server.collector = collector
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,133 @@
+import os
+import mmap
+import struct
+from fward_env import write_file_atomic
+
+# History of the device stats, one directory with two files per device UUID:
+#   <uuid>.raw     every sample of the last raw_hours
+#   <uuid>.hourly  the last sample of every hour before that, kept for hourly_days
+# Every sample is a fixed size record: timestamp, write, read, flush, corruption and generation errors.
+# Records are only appended, in time order, so the files can be mapped and searched by timestamp.
+HISTORY_RECORD = struct.Struct('<6Q')
+
+# Raw files are compacted once their oldest sample is this much older than the retention.
+COMPACT_SLACK = 3600
+
+class HistoryFile:
+    def __init__(self, path):
+        self.path = path
+
+    # A crash can leave a partial record at the end. It is cut off first, records appended after it would be misaligned.
+    def append(self, records):
+        with open(self.path, 'ab') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size % HISTORY_RECORD.size:
+                f.truncate(size - size % HISTORY_RECORD.size)
+            f.write(b''.join(HISTORY_RECORD.pack(*record) for record in records))
+
+    def replace(self, records):
+        write_file_atomic(self.path, b''.join(HISTORY_RECORD.pack(*record) for record in records))
+
+    # Returns the records with a timestamp of at least since, found with a binary search on the mapped file.
+    def read(self, since=0):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            count = size // HISTORY_RECORD.size
+            if count == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                low, high = 0, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if HISTORY_RECORD.unpack_from(mapped, middle * HISTORY_RECORD.size)[0] < since:
+                        low = middle + 1
+                    else:
+                        high = middle
+                return list(HISTORY_RECORD.iter_unpack(mapped[low * HISTORY_RECORD.size:count * HISTORY_RECORD.size]))
+
+    def first_timestamp(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HISTORY_RECORD.size:
+            return None
+        with open(self.path, 'rb') as f:
+            return HISTORY_RECORD.unpack(f.read(HISTORY_RECORD.size))[0]
+
+class DeviceHistory:
+    def __init__(self, history_dir, uuid, raw_hours, hourly_days):
+        self.raw = HistoryFile(os.path.join(history_dir, f'{uuid}.raw'))
+        self.hourly = HistoryFile(os.path.join(history_dir, f'{uuid}.hourly'))
+        self.raw_retention = raw_hours * 3600
+        self.hourly_retention = hourly_days * 86400
+
+    def append(self, timestamp, counters):
+        self.raw.append([(timestamp, *counters)])
+        first = self.raw.first_timestamp()
+        if first is not None and first < timestamp - self.raw_retention - COMPACT_SLACK:
+            self.compact(timestamp)
+
+    # Moves the raw samples past the retention to the hourly file, keeping the last sample of every hour.
+    # Only whole hours are moved, so every hour ends up in the hourly file once.
+    def compact(self, now):
+        records = self.raw.read()
+        cutoff = (now - self.raw_retention) // 3600 * 3600
+        old = [record for record in records if record[0] < cutoff]
+        per_hour = {}
+        for record in old:
+            per_hour[record[0] // 3600] = record
+        hourly = [per_hour[hour] for hour in sorted(per_hour)]
+        hourly_first = self.hourly.first_timestamp()
+        if hourly_first is not None and hourly_first < now - self.hourly_retention - 86400:
+            kept = self.hourly.read(now - self.hourly_retention)
+            self.hourly.replace(kept + hourly)
+        else:
+            self.hourly.append(hourly)
+        self.raw.replace(records[len(old):])
+
+    # All samples since the timestamp, the hourly ones followed by the raw ones.
+    def samples(self, since):
+        raw = self.raw.read(since)
+        hourly = self.hourly.read(since)
+        if raw:
+            hourly = [record for record in hourly if record[0] < raw[0][0]]
+        return hourly + raw
+
+# Records the stats of every device, once per UUID even when it is part of several mounts.
+def record_history(history_dir, mounts, timestamp, raw_hours, hourly_days):
+    os.makedirs(history_dir, exist_ok=True)
+    seen = set()
+    for mount in mounts:
+        for device in mount.devices:
+            if device.uuid in seen:
+                continue
+            seen.add(device.uuid)
+            DeviceHistory(history_dir, device.uuid, raw_hours, hourly_days).append(int(timestamp), device.stats.counters())
+
+# Counts the errors that happened in the period, the sum of all counter increases.
+# A counter that went down was reset, its new value counts as new errors.
+def count_errors(samples, since):
+    # Start from the last sample before the period, if there is one.
+    start = 0
+    for index, record in enumerate(samples):
+        if record[0] <= since:
+            start = index
+        else:
+            break
+    errors = 0
+    for previous, current in zip(samples[start:], samples[start + 1:]):
+        for old, new in zip(previous[1:], current[1:]):
+            errors += new - old if new >= old else new
+    return errors
+
+# Returns (errors in the last hour, errors in the last day) for a device.
+def error_rates(history_dir, uuid, now, raw_hours, hourly_days):
+    history = DeviceHistory(history_dir, uuid, raw_hours, hourly_days)
+    # Include the sample before the day, so the first change of the day is counted.
+    samples = history.samples(now - 86400 - 3600)
+    return count_errors(samples, now - 3600), count_errors(samples, now - 86400)
+
+# The UUIDs that have a history.
+def history_uuids(history_dir):
+    if not os.path.isdir(history_dir):
+        return []
+    return sorted({os.path.splitext(name)[0] for name in os.listdir(history_dir) if name.endswith(('.raw', '.hourly'))})
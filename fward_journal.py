@@ -0,0 +1,82 @@
+import os
+import subprocess
+from datetime import datetime
+from fward_env import write_file_atomic
+
+CURSOR_PREFIX = '-- cursor: '
+
+# Function that reads the journal cursor from a file.
+# If the file does not exist or is empty, it returns None.
+def read_cursor(cursor_file):
+    if not os.path.exists(cursor_file):
+        return None
+    with open(cursor_file, 'r') as f:
+        cursor = f.read().strip()
+    return cursor or None
+
+def write_cursor(cursor_file, cursor):
+    write_file_atomic(cursor_file, cursor)
+
+# Streams journal lines matching a pattern that were logged after the stored cursor.
+# Without a cursor (the first run) at most backlog entries are read, optionally limited to those after since.
+# The cursor of the last line read is only stored by commit(), so lines are read again if the run fails.
+class JournalReader:
+    def __init__(self, cursor_file, grep, backlog, since=None):
+        self.cursor_file = cursor_file
+        self.grep = grep
+        self.backlog = backlog
+        self.since = since
+        self.cursor = read_cursor(cursor_file)
+        self.new_cursor = None
+        self.stale_cursor = False
+        self.lines_read = 0
+
+    def command(self):
+        journalctl_command = [
+            'journalctl', '--no-pager', '--quiet', '--grep', self.grep, '--output', 'cat', '--show-cursor'
+        ]
+        if self.cursor:
+            journalctl_command += ['--after-cursor', self.cursor]
+        else:
+            journalctl_command += ['--lines', str(self.backlog)]
+            if self.since is not None:
+                journalctl_command += ['--since', datetime.fromtimestamp(self.since).strftime('%Y-%m-%d %H:%M:%S')]
+        return journalctl_command
+
+    # Generator that yields the lines one by one, without the trailing newline.
+    # Raises OSError with what journalctl printed when it failed, so the run reports it instead of finding nothing.
+    # With --grep journalctl also exits with 1 when nothing matched, that is only a failure when it says why.
+    # A cursor journalctl can't seek to is dropped, the lines are then read as on the first run.
+    def lines(self):
+        with subprocess.Popen(self.command(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors='replace') as p:
+            try:
+                for line in p.stdout:
+                    line = line.rstrip('\n')
+                    if line.startswith(CURSOR_PREFIX):
+                        self.new_cursor = line[len(CURSOR_PREFIX):]
+                        continue
+                    self.lines_read += 1
+                    yield line
+                p.wait()
+                message = p.stderr.read().strip()
+            finally:
+                # Stop journalctl if the consumer did not read everything.
+                if p.poll() is None:
+                    p.kill()
+        if p.returncode == 0 or not message:
+            return
+        if self.cursor and 'cursor' in message:
+            self.cursor = None
+            self.stale_cursor = True
+            yield from self.lines()
+            return
+        raise OSError(f'journalctl failed with exit code {p.returncode}: {message}')
+
+    # Stores the cursor of the last line read, when there was anything new, or drops a cursor that was stale.
+    def commit(self):
+        if self.new_cursor and self.new_cursor != self.cursor:
+            write_cursor(self.cursor_file, self.new_cursor)
+            self.cursor = self.new_cursor
+        elif self.stale_cursor and os.path.exists(self.cursor_file):
+            os.remove(self.cursor_file)
+        self.stale_cursor = False
@@ -0,0 +1,146 @@
+import os
+import errno
+import selectors
+import subprocess
+
+# Follows the kernel log as it is written, so broken files are reported within seconds instead of on the next check.
+# /dev/kmsg is read directly. Without access to it, journalctl --dmesg --follow is read instead.
+# poll() waits in select() until there is something to read, a quiet log costs no CPU.
+
+KMSG = '/dev/kmsg'
+
+# A record is one read() of /dev/kmsg: "<priority>,<sequence>,<timestamp>,<flags>;<message>",
+# followed by continuation lines that start with a space. Only the message is kept.
+def kmsg_message(record):
+    _, _, text = record.partition(';')
+    if not text:
+        return None
+    return text.split('\n', 1)[0]
+
+class KmsgFollower:
+    def __init__(self, grep, path=KMSG):
+        self.grep = grep
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # Only what is logged from now on, the journal check covers what came before.
+        os.lseek(self.fd, 0, os.SEEK_END)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+        self.source = path
+
+    # Returns the matching lines logged until timeout seconds passed, or right away when there are some.
+    def poll(self, timeout):
+        lines = []
+        if not self.selector.select(timeout):
+            return lines
+        while True:
+            try:
+                record = os.read(self.fd, 8192)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                # The kernel overwrote records before we read them, carry on with the oldest one left.
+                if e.errno == errno.EPIPE:
+                    continue
+                raise
+            message = kmsg_message(record.decode(errors='replace'))
+            if message is not None and self.grep in message:
+                lines.append(message)
+        return lines
+
+    def close(self):
+        self.selector.close()
+        os.close(self.fd)
+
+class JournalFollower:
+    def __init__(self, grep):
+        self.grep = grep
+        self.process = subprocess.Popen(
+            ['journalctl', '--dmesg', '--follow', '--lines', '0', '--no-pager', '--quiet', '--output', 'cat', '--grep', grep],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        os.set_blocking(self.process.stdout.fileno(), False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+        self.buffer = b''
+        self.source = 'journalctl'
+
+    def poll(self, timeout):
+        if not self.selector.select(timeout):
+            return []
+        while True:
+            try:
+                data = os.read(self.process.stdout.fileno(), 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                raise EOFError('journalctl stopped')
+            self.buffer += data
+        *lines, self.buffer = self.buffer.split(b'\n')
+        return [line.decode(errors='replace') for line in lines]
+
+    def close(self):
+        self.selector.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+def follow_kernel_log(grep):
+    try:
+        return KmsgFollower(grep)
+    except (PermissionError, FileNotFoundError):
+        return JournalFollower(grep)
+
+# Collects the references of a burst of warnings, so it is reported as one alert.
+# A burst is ready when no new reference came in for debounce seconds, or max_delay seconds after it started.
+# A reference that was reported is ignored for hold seconds, the kernel logs a bad block on every read of it.
+class BurstCollector:
+    def __init__(self, debounce, max_delay, hold):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.hold = hold
+        self.pending = set()
+        self.first_at = None
+        self.last_at = None
+        self.reported = {}
+        self.suppressed = 0
+
+    def add(self, reference, now):
+        if reference in self.reported and now - self.reported[reference] < self.hold:
+            self.suppressed += 1
+            return
+        if reference in self.pending:
+            return
+        self.pending.add(reference)
+        if self.first_at is None:
+            self.first_at = now
+        self.last_at = now
+
+    # When the pending burst is ready, or None without one.
+    def deadline(self):
+        if not self.pending:
+            return None
+        return min(self.last_at + self.debounce, self.first_at + self.max_delay)
+
+    def ready(self, now):
+        deadline = self.deadline()
+        return deadline is not None and now >= deadline
+
+    # Leaves out the references that are pending or were reported within hold seconds,
+    # e.g. when the journal check finds what was already reported live.
+    def unreported(self, references, now):
+        return {reference for reference in references if reference not in self.pending and now - self.reported.get(reference, now - self.hold) >= self.hold}
+
+    # Holds references that were reported some other way, e.g. by the journal check, like those of a burst.
+    def mark_reported(self, references, now):
+        for reference in references:
+            self.reported[reference] = now
+
+    def take(self, now):
+        references = self.pending
+        self.pending = set()
+        self.first_at = self.last_at = None
+        for reference in references:
+            self.reported[reference] = now
+        self.reported = {reference: at for reference, at in self.reported.items() if now - at < self.hold}
+        return references
@@ -0,0 +1,116 @@
+import re
+
+# Parses the btrfs kernel messages that point at broken data, as journalctl --output cat or /dev/kmsg give them:
+#   csum      BTRFS warning (device sda): csum failed root 5 ino 257 off 4096 csum 0x8941f998 expected csum 0x1e1f4d5b mirror 1
+#             older kernels leave out the root, and log the checksums in decimal
+#   scrub     BTRFS warning (device sda): checksum error at logical 298844160 on dev /dev/sda, physical 298844160, root 5, inode 257, offset 0, length 4096, links 1 (path: dir/file)
+#   metadata  BTRFS warning (device sda): checksum error at logical 30572544 on dev /dev/sda, physical 30572544: metadata leaf (level 0) in tree 5
+#             also "checksum/header error" and "header error", the level is in offset and the tree in root
+#   fixup     BTRFS error (device sda): unable to fixup (regular) error at logical 298844160 on dev /dev/sda
+#             and "fixed up error at logical ...", newer kernels add the physical address
+#   corrected BTRFS info (device sda): read error corrected: ino 257 off 4096 (dev /dev/sda sector 2048)
+# Newer kernels add the state of the filesystem to the device, e.g. (device sda: state EA).
+# One pattern covers them all, it is only compiled once. The formats end in an empty group named after their kind,
+# so match.lastgroup says which one matched without looking at the other groups.
+
+# What the kernel log is filtered on before the lines are parsed. The messages are logged at the warning, error and
+# info levels, so not on the level. It works as a journalctl --grep pattern and as a plain substring.
+MESSAGE_GREP = 'BTRFS'
+
+MESSAGE_PATTERN = re.compile(
+    r'BTRFS (?P<level>\w+) \(device (?P<device>[^):\s]+)[^)]*\): (?:'
+    r'csum failed (?:root (?P<csum_root>-?\d+) )?ino (?P<csum_ino>\d+) off (?P<csum_offset>\d+) csum (?:0x)?(?P<actual>[0-9a-f]+) expected csum (?:0x)?(?P<expected>[0-9a-f]+)(?: mirror (?P<mirror>\d+))?(?P<csum>)'
+    r'|(?:checksum|header|checksum/header) error at logical (?P<logical>\d+) on dev (?P<dev>[^,\s]+), physical (?P<physical>\d+)(?:'
+    r': metadata (?:leaf|node) \(level (?P<tree_level>\d+)\) in tree (?P<tree>\d+)(?P<metadata>)'
+    r'|(?:, root (?P<scrub_root>\d+), inode (?P<scrub_ino>\d+), offset (?P<scrub_offset>\d+), length \d+, links \d+ \(path: (?P<path>.*)\))?(?P<scrub>))'
+    r'|(?:fixed up(?P<fixed>)|unable to fixup \(regular\)(?P<unfixable>)) error at logical (?P<fixup_logical>\d+) on dev (?P<fixup_dev>\S+?)(?:,? physical (?P<fixup_physical>\d+))?$'
+    r'|read error corrected: ino (?P<corrected_ino>\d+) off (?P<corrected_offset>\d+) \(dev (?P<corrected_dev>\S+) sector (?P<sector>\d+)\)(?P<corrected>)'
+    r')'
+)
+
+# One message. Fields a format does not have are None.
+# actual and expected are the checksums as logged, mirror the copy that was read, dev the device the error was on.
+class KernelMessage:
+    __slots__ = ('kind', 'level', 'device', 'root', 'ino', 'offset', 'logical', 'physical', 'mirror', 'actual', 'expected', 'dev', 'path')
+    def __init__(self, kind, level, device, root=None, ino=None, offset=None, logical=None, physical=None, mirror=None, actual=None, expected=None, dev=None, path=None):
+        self.kind = kind
+        self.level = level
+        self.device = device
+        self.root = root
+        self.ino = ino
+        self.offset = offset
+        self.logical = logical
+        self.physical = physical
+        self.mirror = mirror
+        self.actual = actual
+        self.expected = expected
+        self.dev = dev
+        self.path = path
+
+    # What the message is about: the same block logged again, e.g. with another bad checksum, is the same message.
+    def identity(self):
+        return (self.kind, self.device, self.root, self.ino, self.offset, self.logical, self.mirror)
+
+def optional_int(value):
+    return None if value is None else int(value)
+
+# Only the groups of the format that matched are read, fixed and unfixable by the position of their marker.
+def message_from_match(match):
+    kind = match.lastgroup
+    level, device = match.group('level', 'device')
+    if kind == 'csum':
+        root, ino, offset, actual, expected, mirror = match.group('csum_root', 'csum_ino', 'csum_offset', 'actual', 'expected', 'mirror')
+        return KernelMessage('csum', level, device, optional_int(root), int(ino), int(offset), None, None, optional_int(mirror), actual, expected)
+    if kind == 'scrub':
+        root, ino, offset, logical, physical, dev, path = match.group('scrub_root', 'scrub_ino', 'scrub_offset', 'logical', 'physical', 'dev', 'path')
+        return KernelMessage('scrub', level, device, optional_int(root), optional_int(ino), optional_int(offset), int(logical), int(physical), None, None, None, dev, path)
+    if kind == 'metadata':
+        tree, tree_level, logical, physical, dev = match.group('tree', 'tree_level', 'logical', 'physical', 'dev')
+        return KernelMessage('metadata', level, device, int(tree), None, int(tree_level), int(logical), int(physical), None, None, None, dev)
+    if kind == 'corrected':
+        ino, offset, dev, sector = match.group('corrected_ino', 'corrected_offset', 'corrected_dev', 'sector')
+        return KernelMessage('corrected', level, device, None, int(ino), int(offset), None, int(sector) * 512, None, None, None, dev)
+    # The fixup formats end in the optional physical address, their marker comes before it.
+    kind = 'fixed' if match.start('fixed') >= 0 else 'unfixable'
+    logical, dev, physical = match.group('fixup_logical', 'fixup_dev', 'fixup_physical')
+    return KernelMessage(kind, level, device, None, None, None, int(logical), optional_int(physical), None, None, None, dev)
+
+# Returns the KernelMessage of the line, or None when it is not one.
+def parse_message(line):
+    match = MESSAGE_PATTERN.search(line)
+    return None if match is None else message_from_match(match)
+
+# Generator that yields a KernelMessage for every line that is one.
+def parse_messages(lines):
+    search = MESSAGE_PATTERN.search
+    for line in lines:
+        match = search(line)
+        if match is not None:
+            yield message_from_match(match)
+
+# How many of the distinct lines seen last unique_lines remembers, between this many and twice as many.
+UNIQUE_LINES_RECENT = 65536
+
+# Generator that leaves out lines that were seen recently, a burst logs the same line over and over.
+# Much cheaper than parsing them again, the hash of a string is only computed once.
+# Only the recent lines are kept, so a long read of distinct lines does not pile up in memory. A line that comes
+# back after that is parsed again, unique_messages still leaves it out.
+def unique_lines(lines, recent=UNIQUE_LINES_RECENT):
+    seen = set()
+    previous = set()
+    for line in lines:
+        if line in seen or line in previous:
+            continue
+        seen.add(line)
+        if len(seen) >= recent:
+            previous, seen = seen, set()
+        yield line
+
+# Generator that leaves out the messages that were seen before, while they stream by.
+def unique_messages(messages):
+    seen = set()
+    for message in messages:
+        identity = message.identity()
+        if identity not in seen:
+            seen.add(identity)
+            yield message
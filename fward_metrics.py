@@ -0,0 +1,151 @@
+import threading
+from fward_env import write_file_atomic
+from fward_scrub import SCRUB_ERROR_FIELDS
+
+# Metrics in the Prometheus text format, for the node_exporter textfile collector or scraped from /metrics.
+# They are rendered once per check, a scrape only returns the last rendered text and never touches the filesystems.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The type label of fward_device_errors_total, in the order of BtrfsDeviceStats.counters().
+ERROR_TYPES = ('write', 'read', 'flush', 'corruption', 'generation')
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+class MetricsWriter:
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, metric_type, help_text, samples):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in samples:
+            self.lines.append(f'{name}{format_labels(labels)} {value}')
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+# The state the metrics are rendered from, updated by the checks.
+# Shared with the threads of the metrics server, so the rendered text is swapped under a lock.
+class FwardMetrics:
+    def __init__(self, textfile=None):
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.mounts = []
+        self.unresponsive = []
+        self.failed = {}
+        self.timings = {}
+        self.scrubs = {}
+        self.space = {}
+        self.subvolumes = {}
+        self.scan_duration = None
+        self.scanned_at = None
+        self.broken_files = None
+        self.content = b''
+
+    def update_scan(self, scan, duration, scanned_at):
+        self.mounts = scan.mounts
+        self.unresponsive = scan.unresponsive
+        self.failed = scan.failed
+        self.timings = scan.timings
+        self.scrubs = scan.scrubs
+        self.space = scan.space
+        self.subvolumes = scan.subvolumes
+        self.scan_duration = duration
+        self.scanned_at = scanned_at
+
+    def update_broken_files(self, count):
+        self.broken_files = count
+
+    def render(self):
+        writer = MetricsWriter()
+        writer.metric('fward_mounts', 'gauge', 'Number of mounted btrfs filesystems.', [((), len(self.mounts))])
+        writer.metric('fward_devices', 'gauge', 'Number of devices in the mounted btrfs filesystems.', [((), sum(len(mount.devices) for mount in self.mounts))])
+        writer.metric('fward_mount_devices', 'gauge', 'Number of devices of a filesystem.', [((('mount', mount.mount_point),), len(mount.devices)) for mount in self.mounts])
+        writer.metric('fward_mount_unresponsive', 'gauge', 'Whether the filesystem did not answer within the scan timeout.', [((('mount', mount.mount_point),), int(mount.mount_point in self.unresponsive)) for mount in self.mounts])
+        writer.metric('fward_mount_scan_failed', 'gauge', 'Whether the last scan of the filesystem failed.', [((('mount', mount.mount_point),), int(mount.mount_point in self.failed)) for mount in self.mounts])
+        writer.metric('fward_device_errors_total', 'counter', 'Error counters of a device, as reported by the kernel.', [
+            ((('mount', mount.mount_point), ('device', device.device), ('uuid', device.uuid), ('type', error_type)), value)
+            for mount in self.mounts for device in mount.devices for error_type, value in zip(ERROR_TYPES, device.stats.counters())
+        ])
+        if self.scrubs:
+            scrubs = [((('mount', mount_point), ('device', scrub.device), ('uuid', scrub.uuid)), scrub) for mount_point, device_scrubs in self.scrubs.items() for scrub in device_scrubs]
+            running = [(labels, scrub.progress) for labels, scrub in scrubs if scrub.progress is not None]
+            writer.metric('fward_scrub_running', 'gauge', 'Whether a scrub is running on the device.', [(labels, int(scrub.progress is not None)) for labels, scrub in scrubs])
+            writer.metric('fward_scrub_bytes_scrubbed', 'gauge', 'Bytes the running scrub has scrubbed so far.', [(labels, progress.bytes_scrubbed()) for labels, progress in running])
+            writer.metric('fward_scrub_errors', 'gauge', 'Errors the running scrub has found so far.', [
+                (labels + (('type', name.replace('_errors', '')),), value) for labels, progress in running for name, value in zip(SCRUB_ERROR_FIELDS, progress.errors())
+            ])
+            writer.metric('fward_scrub_last_finished_timestamp_seconds', 'gauge', 'Unix time the last complete scrub of the device finished.', [(labels, scrub.last_finished) for labels, scrub in scrubs if scrub.last_finished is not None])
+        if self.space:
+            types = [((('mount', mount_point), ('type', space_type), ('profile', space.profiles[space_type])), values) for mount_point, space in self.space.items() for space_type, values in space.types.items()]
+            devices = [((('mount', mount_point), ('device', device.device)), device) for mount_point, space in self.space.items() for device in space.devices]
+            writer.metric('fward_space_allocated_bytes', 'gauge', 'Bytes allocated to chunks of a type, before the profile.', [(labels, allocated) for labels, (allocated, used) in types])
+            writer.metric('fward_space_used_bytes', 'gauge', 'Bytes used in the chunks of a type, before the profile.', [(labels, used) for labels, (allocated, used) in types])
+            writer.metric('fward_space_global_reserve_bytes', 'gauge', 'Size of the global metadata reserve.', [((('mount', mount_point),), space.global_reserve) for mount_point, space in self.space.items()])
+            writer.metric('fward_device_size_bytes', 'gauge', 'Size of a device as btrfs uses it.', [(labels, device.size) for labels, device in devices])
+            writer.metric('fward_device_unallocated_bytes', 'gauge', 'Bytes of a device not allocated to any chunk.', [(labels, device.unallocated()) for labels, device in devices])
+            writer.metric('fward_device_allocated_bytes', 'gauge', 'Bytes of a device allocated to chunks of a type.', [
+                (labels + (('type', space_type),), size) for labels, device in devices for space_type, size in device.by_type.items()
+            ])
+        if self.subvolumes:
+            qgroups = [((('mount', mount_point), ('qgroup', qgroup.name), ('path', qgroup.path or '')), qgroup) for mount_point, status in self.subvolumes.items() for qgroup in status.qgroups.values()]
+            writer.metric('fward_subvolumes', 'gauge', 'Number of subvolumes and snapshots of a filesystem.', [((('mount', mount_point),), len(status.subvolumes)) for mount_point, status in self.subvolumes.items()])
+            writer.metric('fward_qgroup_referenced_bytes', 'gauge', 'Bytes referenced by a qgroup.', [(labels, qgroup.referenced) for labels, qgroup in qgroups])
+            writer.metric('fward_qgroup_exclusive_bytes', 'gauge', 'Bytes referenced by a qgroup only.', [(labels, qgroup.exclusive) for labels, qgroup in qgroups])
+            writer.metric('fward_qgroup_limit_bytes', 'gauge', 'Limit of a qgroup, when it has one.', [
+                (labels + (('type', kind),), limit) for labels, qgroup in qgroups for kind, limit in (('referenced', qgroup.max_referenced), ('exclusive', qgroup.max_exclusive)) if limit
+            ])
+            writer.metric('fward_qgroup_growth_bytes_per_day', 'gauge', 'Growth of the bytes referenced by a qgroup, over up to the last day.', [(labels, qgroup.growth) for labels, qgroup in qgroups if qgroup.growth is not None])
+        if self.broken_files is not None:
+            writer.metric('fward_broken_files', 'gauge', 'Number of broken files found in the journal by the last check.', [((), self.broken_files)])
+        writer.metric('fward_mount_scan_duration_seconds', 'gauge', 'Time the last scan of a filesystem took.', [((('mount', mount_point),), float(duration)) for mount_point, duration in self.timings.items()])
+        if self.scan_duration is not None:
+            writer.metric('fward_scan_duration_seconds', 'gauge', 'Time the last scan of all filesystems took.', [((), float(self.scan_duration))])
+            writer.metric('fward_last_scan_timestamp_seconds', 'gauge', 'Unix time of the last scan.', [((), float(self.scanned_at))])
+        return writer.text()
+
+    # Renders the metrics for the scrapes to come, and writes the textfile when there is one.
+    def publish(self):
+        text = self.render()
+        with self.lock:
+            self.content = text.encode()
+        if self.textfile:
+            write_file_atomic(self.textfile, text)
+
+    def scrape(self):
+        with self.lock:
+            return self.content
+
+# Serves /metrics on its own threads until shutdown() is called on the returned server.
+# http.server is only imported here, only the daemon serves metrics.
+def start_metrics_server(metrics, address, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = self.server.metrics.scrape()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes are not worth a log line each.
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,45 @@
+# The snapshot model. These objects are created for every device on every run,
+# so they use __slots__ to stay small and quick to build.
+
+class BtrfsDeviceStats:
+    __slots__ = ('write_errors', 'read_errors', 'flush_errors', 'corruption_errors', 'generation_errors')
+    def __init__(self, write_errors, read_errors, flush_errors, corruption_errors, generation_errors):
+        self.write_errors = write_errors
+        self.read_errors = read_errors
+        self.flush_errors = flush_errors
+        self.corruption_errors = corruption_errors
+        self.generation_errors = generation_errors
+
+    # The counters as a tuple, in a fixed order.
+    def counters(self):
+        return (self.write_errors, self.read_errors, self.flush_errors, self.corruption_errors, self.generation_errors)
+
+    # Field-wise comparison of the counters.
+    def __eq__(self, other):
+        if not isinstance(other, BtrfsDeviceStats):
+            return NotImplemented
+        return self.counters() == other.counters()
+    
+class BtrfsDevice:
+    __slots__ = ('device', 'uuid', 'stats')
+    def __init__(self, device, uuid, stats):
+        self.device = device
+        self.uuid = uuid
+        self.stats = stats
+
+# aliases are the other mount points of the same filesystem, e.g. its subvolumes.
+class BtrfsMountPoint:
+    __slots__ = ('mount_point', 'devices', 'aliases')
+    def __init__(self, mount_point, devices, aliases=None):
+        self.mount_point = mount_point
+        self.devices = devices
+        self.aliases = aliases or list()
+
+class BtrfsMountChanges:
+    __slots__ = ('added_mounts', 'removed_mounts', 'added_devices', 'removed_devices', 'changed_devices')
+    def __init__(self, added_mounts, removed_mounts, added_devices, removed_devices, changed_devices):
+        self.added_mounts = added_mounts
+        self.removed_mounts = removed_mounts
+        self.added_devices = added_devices
+        self.removed_devices = removed_devices
+        self.changed_devices = changed_devices
@@ -0,0 +1,57 @@
+import select
+
+MOUNTINFO = '/proc/self/mountinfo'
+
+# Mount points in mountinfo escape space, tab, newline and backslash as octal.
+def unescape_mount_point(mount_point):
+    if '\\' not in mount_point:
+        return mount_point
+    return mount_point.encode().decode('unicode_escape').encode('latin-1').decode(errors='replace')
+
+# Parses the text of /proc/self/mountinfo and returns the live btrfs filesystems,
+# as a list of mount point lists, one per filesystem.
+# Every subvolume mount of a filesystem has the same device number, so they are grouped by it.
+# The first mount point of a group is the one fward reports on, preferring a mount of the top level
+# subvolume and then the shortest path, so it stays the same between runs. The others are aliases.
+def parse_mountinfo(text):
+    filesystems = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if '-' not in fields:
+            continue
+        separator = fields.index('-')
+        if fields[separator + 1] != 'btrfs':
+            continue
+        device_number, root, mount_point = fields[2], fields[3], unescape_mount_point(fields[4])
+        filesystems.setdefault(device_number, []).append((root != '/', len(mount_point), mount_point))
+    return [[mount_point for _, _, mount_point in sorted(mounts)] for mounts in filesystems.values()]
+
+# The btrfs filesystems of the mount table, kept in memory.
+# The kernel flags a change of the mount table through poll() on the open mountinfo file,
+# only then is the file read and parsed again.
+class MountTable:
+    def __init__(self, path=MOUNTINFO):
+        self.file = open(path, 'r')
+        self.poller = select.poll()
+        self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        self.filesystems = self.parse()
+
+    def parse(self):
+        self.file.seek(0)
+        return parse_mountinfo(self.file.read())
+
+    def changed(self):
+        return bool(self.poller.poll(0))
+
+    def btrfs_filesystems(self):
+        if self.changed():
+            self.filesystems = self.parse()
+        return self.filesystems
+
+    def close(self):
+        self.file.close()
+
+# Reads the mount table once.
+def find_btrfs_filesystems(path=MOUNTINFO):
+    with open(path, 'r') as f:
+        return parse_mountinfo(f.read())
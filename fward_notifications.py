@@ -1,11 +1,20 @@
-import apprise
-from apprise import NotifyType
-from dataclasses import dataclass
+import os
+import json
+import time
+import hashlib
+import threading
+from fward_env import write_file_atomic
+try:
+    import syslog
+except ImportError:
+    syslog = None
 
 global notifier
 
+# apprise takes longer to import than all of fward, so it is only imported when something is sent.
 def create_apprise_object(configfile):
     try:
+        import apprise
         apobj = apprise.Apprise()
         # Read the configuration file
         # And add on split lines.
@@ -18,47 +27,238 @@ def create_apprise_object(configfile):
         print(f'Failed to create apprise object: {e}')
         return None
 
+# Severities from low to high, stored by their index.
+# These are the values of apprise's NotifyType, which accepts them as they are.
+NOTIFY_INFO = 'info'
+NOTIFY_WARNING = 'warning'
+NOTIFY_FAILURE = 'failure'
+SEVERITIES = [NOTIFY_INFO, NOTIFY_WARNING, NOTIFY_FAILURE]
+SEVERITY_TITLES = ['[LOG] Btrfs Monitor', '[WARNING] Btrfs Monitor', '[ERROR] Btrfs Monitor']
+SEVERITY_HEADERS = ['Info', 'Warnings', 'Errors']
+
+# Messages kept per target while it is cooling down, older ones are only counted.
+MAX_PENDING_MESSAGES = 100
+
+# Builds one digest out of [severity, mount, body] messages.
+# Returns the notify type and title of the highest severity, and the body grouped by severity and mount.
+def build_digest(messages, dropped=0):
+    severity = max(message[0] for message in messages)
+    if len(messages) == 1 and not dropped:
+        return SEVERITIES[severity], SEVERITY_TITLES[severity], messages[0][2]
+    lines = []
+    for level in reversed(range(len(SEVERITIES))):
+        group = [message for message in messages if message[0] == level]
+        if not group:
+            continue
+        lines.append(f'{SEVERITY_HEADERS[level]} ({len(group)}):')
+        per_mount = {}
+        for _, mount, body in group:
+            per_mount.setdefault(mount, []).append(body)
+        # Messages without a mount go first, so they don't read as part of the last mount.
+        for mount in sorted(per_mount, key=lambda mount: mount is not None):
+            bodies = per_mount[mount]
+            if mount:
+                lines.append(f'{mount}:')
+            for body in bodies:
+                lines.append('- ' + body.replace('\n', '\n  '))
+        lines.append('')
+    if dropped:
+        lines.append(f'{dropped} older messages were left out during the cooldown.')
+    return SEVERITIES[severity], SEVERITY_TITLES[severity], '\n'.join(lines).strip()
+
+# Sends one digest to one target on its own thread, retrying with exponential backoff
+# until it succeeds, runs out of retries or the deadline would be passed.
+# The thread is a daemon thread, a target that hangs can't keep fward from exiting.
+class Delivery(threading.Thread):
+    def __init__(self, server, digest, count, deadline, retries, backoff=1):
+        super().__init__(daemon=True)
+        self.server = server
+        self.digest = digest
+        # The number of pending messages in the digest.
+        self.count = count
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.success = False
+        self.sent_at = None
+
+    def run(self):
+        notify_type, title, body = self.digest
+        for attempt in range(self.retries + 1):
+            try:
+                if self.server.notify(body=body, title=title, notify_type=notify_type):
+                    self.success = True
+                    self.sent_at = time.time()
+                    return
+            except Exception:
+                pass
+            delay = self.backoff * 2 ** attempt
+            if attempt == self.retries or time.monotonic() + delay >= self.deadline:
+                return
+            time.sleep(delay)
+
+# Stands in for the Apprise object during a run: notify() only buffers the message,
+# flush() sends everything as one digest per target.
+# The notifier config is only read when there is something to send.
+# The messages are queued per target in the state file before anything is sent, and only removed once a
+# target accepted them. A target that was sent to less than cooldown seconds ago, failed, or did not answer
+# within timeout seconds keeps its messages and gets them with the next digest.
+# Targets are sent to at the same time, so flush() never takes much longer than timeout.
+class NotificationCollector:
+    def __init__(self, config_file, state_file, cooldown=0, timeout=30, retries=2):
+        self.config_file = config_file
+        self.loaded_apobj = None
+        self.state_file = state_file
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.retries = retries
+        self.messages = []
+        # Deliveries that were still running when the previous flush() gave up waiting, by target key.
+        self.in_flight = {}
+
+    # The Apprise object, or None when the config could not be read.
+    @property
+    def apobj(self):
+        if self.loaded_apobj is None:
+            self.loaded_apobj = create_apprise_object(self.config_file)
+        return self.loaded_apobj
+
+    def notify(self, body, title='', notify_type=NOTIFY_INFO, mount=None):
+        self.messages.append([SEVERITIES.index(notify_type), mount, body])
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def save_state(self, state):
+        write_file_atomic(self.state_file, json.dumps(state))
+
+    @staticmethod
+    def target_key(server):
+        return hashlib.sha1(server.url().encode()).hexdigest()
+
+    # Removes the messages a delivery sent from the front of the queue.
+    @staticmethod
+    def mark_sent(target, delivery):
+        target.update(last_sent=delivery.sent_at, pending=target['pending'][delivery.count:], dropped=0)
+
+    # Picks up the deliveries of an earlier flush() that finished since.
+    def collect_late_deliveries(self, state):
+        changed = False
+        for key, delivery in list(self.in_flight.items()):
+            if delivery.is_alive():
+                continue
+            del self.in_flight[key]
+            if delivery.success and key in state:
+                self.mark_sent(state[key], delivery)
+                changed = True
+        return changed
+
+    # Returns the number of digests that were delivered.
+    def flush(self):
+        state = self.load_state()
+        changed = self.collect_late_deliveries(state)
+        if not self.messages and not any(target['pending'] for target in state.values()):
+            if changed:
+                self.save_state(state)
+            return 0
+        apobj = self.apobj
+        if apobj is None:
+            # Keep the messages and the queue, the config may be readable again on the next flush.
+            return 0
+        now = time.time()
+        # Targets that were removed from the config are forgotten.
+        new_state = {}
+        sends = []
+        for server in apobj:
+            key = self.target_key(server)
+            target = new_state[key] = state.get(key, {'last_sent': 0, 'pending': [], 'dropped': 0})
+            pending = target['pending'] + self.messages
+            if not pending:
+                continue
+            if len(pending) > MAX_PENDING_MESSAGES:
+                target['dropped'] += len(pending) - MAX_PENDING_MESSAGES
+                pending = pending[-MAX_PENDING_MESSAGES:]
+            target['pending'] = pending
+            if key in self.in_flight or now - target['last_sent'] < self.cooldown:
+                continue
+            sends.append((key, server, target))
+        self.messages = []
+        # Queue everything on disk first, so a crash or kill while sending loses nothing.
+        self.save_state(new_state)
+        if not sends:
+            return 0
+
+        deadline = time.monotonic() + self.timeout
+        for key, server, target in sends:
+            delivery = Delivery(server, build_digest(target['pending'], target['dropped']), len(target['pending']), deadline, self.retries)
+            self.in_flight[key] = delivery
+            delivery.start()
+        delivered = 0
+        for key, server, target in sends:
+            delivery = self.in_flight[key]
+            delivery.join(max(0, deadline - time.monotonic()))
+            if delivery.is_alive():
+                # Left running, a later flush() picks up its result.
+                continue
+            del self.in_flight[key]
+            if delivery.success:
+                self.mark_sent(target, delivery)
+                delivered += 1
+        self.save_state(new_state)
+        return delivered
+
+syslog_opened = False
+
+# Writes to syslog when it is available, opening it on the first message.
+# priority is the name of a syslog priority, e.g. 'LOG_INFO'.
+def write_syslog(priority, message):
+    global syslog_opened
+    if syslog is None:
+        return
+    try:
+        if not syslog_opened:
+            syslog.openlog()
+            syslog_opened = True
+        syslog.syslog(getattr(syslog, priority), message)
+    except Exception:
+        pass
+
 # Function that logs a message.
 # It will also do a syslog if it is available.
-def info(message, notifier=None):
+# The mount, when given, is used to group the message in the digest.
+def info(message, notifier=None, mount=None):
     print("[FWARD][INFO] " + message)
-    # Try to log to syslog
-    try:
-        import syslog
-        syslog.syslog(syslog.LOG_INFO, message)
-    except:
-        pass
+    write_syslog('LOG_INFO', message)
     if notifier:
         notifier.notify(
                 body=message,
                 title='[LOG] Btrfs Monitor',
-                notify_type=NotifyType.INFO
+                notify_type=NOTIFY_INFO,
+                mount=mount
             )
-def error(message, notifier=None):
+def error(message, notifier=None, mount=None):
     print("[FWARD][ERROR] " + message)
-    # Try to log to syslog
-    try:
-        import syslog
-        syslog.syslog(syslog.LOG_ERR, message)
-    except:
-        pass
+    write_syslog('LOG_ERR', message)
     if notifier:
         notifier.notify(
                 body=message,
                 title='[ERROR] Btrfs Monitor',
-                notify_type=NotifyType.FAILURE
+                notify_type=NOTIFY_FAILURE,
+                mount=mount
             )
-def warn(message, notifier=None):
+def warn(message, notifier=None, mount=None):
     print("[FWARD][WARN] " + message)
-    # Try to log to syslog
-    try:
-        import syslog
-        syslog.syslog(syslog.LOG_WARNING, message)
-    except:
-        pass
+    write_syslog('LOG_WARNING', message)
     if notifier:
         notifier.notify(
                 body=message,
                 title='[WARNING] Btrfs Monitor',
-                notify_type=NotifyType.WARNING
-            )
\ No newline at end of file
+                notify_type=NOTIFY_WARNING,
+                mount=mount
+            )
@@ -0,0 +1,89 @@
+import json
+import time
+import threading
+from contextlib import nullcontext
+from fward_env import write_file_atomic
+
+# Timing of the phases of a run, and counts of what it did.
+# The instrumented code calls profile_phase() and profile_count(), which record to the profile of the running pass.
+# Without one, profile_phase() returns a shared no-op context and profile_count() returns right away.
+
+class RunProfile:
+    def __init__(self):
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.phases = {}
+        self.counts = {}
+        # The resolve workers record from their own threads.
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def summary(self):
+        return {
+            'started_at': self.started_at,
+            'duration': self.duration,
+            'phases': self.phases,
+            'counts': self.counts,
+        }
+
+    def print_breakdown(self):
+        print(f'{"Phase":<16} {"Seconds":>10} {"Share":>8}')
+        for name, seconds in sorted(self.phases.items(), key=lambda item: -item[1]):
+            share = seconds / self.duration * 100 if self.duration else 0
+            print(f'{name:<16} {seconds:>10.4f} {share:>7.1f}%')
+        print(f'{"total":<16} {self.duration:>10.4f}')
+        for name, value in sorted(self.counts.items()):
+            print(f'{name:<16} {value:>10}')
+
+class Phase:
+    __slots__ = ('profile', 'name', 'started')
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add(self.name, time.perf_counter() - self.started)
+
+NO_PHASE = nullcontext()
+
+active = None
+
+def start_profile():
+    global active
+    active = RunProfile()
+    return active
+
+def stop_profile():
+    global active
+    profile, active = active, None
+    if profile is not None:
+        profile.finish()
+    return profile
+
+def profile_phase(name):
+    profile = active
+    if profile is None:
+        return NO_PHASE
+    return Phase(profile, name)
+
+def profile_count(name, n=1):
+    profile = active
+    if profile is not None:
+        profile.count(name, n)
+
+def write_run_summary(summary_file, profile):
+    write_file_atomic(summary_file, json.dumps(profile.summary(), indent=2))
@@ -0,0 +1,282 @@
+import os
+import json
+import errno
+import threading
+import subprocess
+from collections import OrderedDict
+from fward_env import write_file_atomic
+from fward_profile import profile_phase, profile_count
+
+PATH_CACHE_VERSION = 1
+
+# Errors that mean the kernel or our privileges don't support the ioctl, we use the btrfs CLI instead.
+UNSUPPORTED_ERRNOS = {errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL, errno.EPERM}
+
+# The kernel logs devices by name, e.g. sda or dm-0, so we index by the name of the device path.
+# Symlinks like /dev/mapper/... are followed, so both names point to the same mount.
+def build_device_index(mounts):
+    index = {}
+    for mount in mounts:
+        for dev in mount.devices:
+            for path in (dev.device, os.path.realpath(dev.device)):
+                index.setdefault(os.path.basename(path), mount.mount_point)
+    return index
+
+# Runs btrfs inspect-internal inode-resolve or logical-resolve and returns the paths it printed.
+def resolve_with_cli(kind, number, mount_point):
+    btrfs_command = [
+        'btrfs', 'inspect-internal', f'{kind}-resolve', str(number), mount_point
+    ]
+    profile_count('cli_resolves')
+    with profile_phase('resolve_cli'):
+        result = subprocess.run(btrfs_command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    if result.returncode != 0:
+        return []
+    return [line for line in result.stdout.strip().split('\n') if line]
+
+# btrfs is imported where it is used, a run without broken files doesn't need it here.
+
+# Returns the id of the subvolume that is mounted at the mount point.
+def mounted_subvolume(fs):
+    import btrfs
+    return btrfs.ioctl.ino_lookup(fs.fd, objectid=btrfs.ctree.FIRST_FREE_OBJECTID).treeid
+
+# The lookup returns the path with a trailing slash, relative to the subvolume.
+def lookup_path(fs, mount_point, treeid, ino):
+    import btrfs
+    result = btrfs.ioctl.ino_lookup(fs.fd, treeid=treeid, objectid=ino)
+    return os.path.join(mount_point, result.name_bytes.decode(errors='replace').rstrip('/'))
+
+# Returns the generation of the subvolume tree, it changes with every transaction that touches the subvolume.
+def subvolume_generation(fs, subvolume):
+    for root in fs.subvolumes(min_id=subvolume, max_id=subvolume):
+        return root.generation
+    return None
+
+# Returns the generation of the extent tree, it changes with every transaction that allocates or frees an extent.
+# Used as the generation of the filesystem: while it is unchanged, no logical address was reused.
+def filesystem_generation(fs):
+    import btrfs
+    return subvolume_generation(fs, btrfs.ctree.EXTENT_TREE_OBJECTID)
+
+# Returns the generation the inode was created in, or None if it does not exist.
+# When an inode number is reused, the generation is different.
+def inode_generation(fs, subvolume, ino):
+    import btrfs
+    key = btrfs.ctree.Key(ino, btrfs.ctree.INODE_ITEM_KEY, 0)
+    for item in fs.search(subvolume, key, key):
+        return item.generation
+    return None
+
+# Returns the path of a subvolume relative to the top level subvolume, following its back references up.
+def subvolume_path(fs, subvolume):
+    import btrfs
+    names = []
+    while subvolume != btrfs.ctree.FS_TREE_OBJECTID:
+        min_key = btrfs.ctree.Key(subvolume, btrfs.ctree.ROOT_BACKREF_KEY, 0)
+        max_key = btrfs.ctree.Key(subvolume, btrfs.ctree.ROOT_BACKREF_KEY, btrfs.ctree.ULLONG_MAX)
+        for header, data in btrfs.ioctl.search_v2(fs.fd, btrfs.ctree.ROOT_TREE_OBJECTID, min_key, max_key, nr_items=1):
+            # A back reference is keyed (subvolume, ROOT_BACKREF, parent), with the same item as a ROOT_REF.
+            ref = btrfs.ctree.RootRef(header, data)
+            directory = btrfs.ioctl.ino_lookup(fs.fd, treeid=header.offset, objectid=ref.dirid).name_bytes
+            names.append((directory + ref.name).decode(errors='replace'))
+            subvolume = header.offset
+            break
+        else:
+            raise OSError(errno.ENOENT, f'Subvolume {subvolume} has no back reference')
+    return os.path.join(*reversed(names)) if names else ''
+
+# Where the files of a subvolume are, as seen from the mount point of another one.
+# A subvolume outside of the mounted one can't be reached through it, it is shown from the top level as <FS_TREE>/path.
+def subvolume_location(fs, mount_point, mounted, subvolume):
+    path = subvolume_path(fs, subvolume)
+    mounted_path = subvolume_path(fs, mounted)
+    if not mounted_path:
+        return os.path.join(mount_point, path)
+    if path.startswith(mounted_path + '/'):
+        return os.path.join(mount_point, os.path.relpath(path, mounted_path))
+    return os.path.join('<FS_TREE>', path)
+
+# The resolvers return the paths and the inode numbers in the tree they belong to: root when given,
+# otherwise the mounted subvolume. The kernel logs the root of an inode, older kernels leave it out.
+def resolve_ino(fs, mount_point, ino, root=None):
+    subvolume = mounted_subvolume(fs) if root is not None else None
+    if root is None or root == subvolume:
+        return [lookup_path(fs, mount_point, 0, ino)], [ino]
+    return [lookup_path(fs, subvolume_location(fs, mount_point, subvolume, root), root, ino)], [ino]
+
+def resolve_logical(fs, mount_point, logical, root=None):
+    import btrfs
+    inodes, _ = btrfs.ioctl.logical_ino(fs.fd, logical)
+    subvolume = mounted_subvolume(fs)
+    if any(inode.root != subvolume for inode in inodes):
+        # Files in other subvolumes can't be reached from this mount point by the ioctl alone.
+        return resolve_with_cli('logical', logical, mount_point), []
+    return [lookup_path(fs, mount_point, inode.root, inode.inum) for inode in inodes], [inode.inum for inode in inodes]
+
+RESOLVERS = {
+    'inode': resolve_ino,
+    'logical': resolve_logical,
+}
+
+# On-disk cache of resolved paths, keyed by filesystem, subvolume and inode or logical address.
+# The subvolume is the root the kernel logged with an inode, otherwise the mounted one.
+# Entries are evicted least recently used first once there are more than max_entries.
+# An entry is valid while the subvolume generation is unchanged, or otherwise while all its inodes still have
+# the generation they had when the entry was made. An entry of a logical address is only valid while the
+# filesystem generation is unchanged. Shared by the resolve workers, so access is locked.
+class PathCache:
+    def __init__(self, cache_file, max_entries):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.dirty = False
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    # Read on first use, most runs have nothing to resolve. Called with the lock held.
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            # A broken cache only costs us the lookups, start over.
+            return
+        if data.get('version') != PATH_CACHE_VERSION:
+            return
+        self.entries = OrderedDict(data['entries'])
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {'version': PATH_CACHE_VERSION, 'entries': list(self.entries.items())}
+            self.dirty = False
+        write_file_atomic(self.cache_file, json.dumps(data))
+
+    @staticmethod
+    def key(fsid, subvolume, kind, number):
+        return f'{fsid}/{subvolume}/{kind}/{number}'
+
+    def get(self, key):
+        with self.lock:
+            self.load()
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            self.load()
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.dirty = True
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+def cache_entry_is_valid(fs, kind, subvolume, generation, fs_generation, entry):
+    # Once an extent is rewritten its address can be reused by another file, the inodes can't tell.
+    if kind == 'logical':
+        return entry.get('fs_generation') == fs_generation
+    if entry['generation'] == generation:
+        return True
+    if not entry['inodes']:
+        return False
+    return all(inode_generation(fs, subvolume, ino) == inode_gen for ino, inode_gen in entry['inodes'])
+
+# Resolves all references of one filesystem, with one open handle.
+def resolve_filesystem(mount_point, references, handles=None, cache=None):
+    import btrfs
+    paths = []
+    fs = handles.get(mount_point) if handles is not None else btrfs.FileSystem(mount_point)
+    try:
+        if cache is not None:
+            try:
+                fsid = str(fs.fsid)
+                fs_generation = filesystem_generation(fs)
+                subvolume = mounted_subvolume(fs)
+                generations = {}
+            except OSError:
+                # Without the ioctls there is nothing to validate the entries with.
+                cache = None
+        for kind, number, root in references:
+            number = int(number)
+            if cache is not None:
+                tree = subvolume if root is None else root
+                if tree not in generations:
+                    try:
+                        generations[tree] = subvolume_generation(fs, tree)
+                    except OSError:
+                        # The subvolume is gone, its inodes can't be looked up any more.
+                        generations[tree] = None
+                generation = generations[tree]
+                key = PathCache.key(fsid, tree, kind, number)
+                entry = cache.get(key)
+                valid = entry is not None and generation is not None and cache_entry_is_valid(fs, kind, tree, generation, fs_generation, entry)
+                cache.count(valid)
+                if valid:
+                    if entry['generation'] != generation:
+                        entry['generation'] = generation
+                        cache.put(key, entry)
+                    paths.extend(entry['paths'])
+                    continue
+            try:
+                found, inodes = RESOLVERS[kind](fs, mount_point, number, root)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    # The inode or extent is gone, nothing to report.
+                    continue
+                found, inodes = resolve_with_cli(kind, number, mount_point), []
+            paths.extend(found)
+            if cache is not None and found:
+                cache.put(key, {
+                    'paths': found,
+                    'generation': generation,
+                    'fs_generation': fs_generation,
+                    'inodes': [[ino, inode_generation(fs, tree, ino)] for ino in inodes],
+                })
+    finally:
+        if handles is None:
+            fs.__exit__(None, None, None)
+    return paths
+
+# Resolves (kind, device, number, root) references to paths, where kind is 'inode' or 'logical'.
+# root is the subvolume of an inode, None when not known or for a logical address.
+# Each filesystem is resolved on its own worker, with at most workers running at once.
+# Returns the paths and the references whose device is not part of any mount.
+# resolve is called per filesystem, the backend can pass its own.
+def resolve_broken_files(mounts, references, workers, handles=None, cache=None, resolve=resolve_filesystem):
+    device_index = build_device_index(mounts)
+    per_filesystem = {}
+    unknown = []
+    for kind, device, number, root in references:
+        mount_point = device_index.get(device)
+        if mount_point is None:
+            unknown.append((kind, device, number))
+            continue
+        per_filesystem.setdefault(mount_point, []).append((kind, number, root))
+    if not per_filesystem:
+        return [], unknown
+
+    from concurrent.futures import ThreadPoolExecutor
+    paths = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(per_filesystem)))) as pool:
+        futures = [pool.submit(resolve, mount_point, refs, handles, cache) for mount_point, refs in per_filesystem.items()]
+        for future in futures:
+            paths.extend(future.result())
+    return paths, unknown
@@ -0,0 +1,182 @@
+import os
+import json
+import errno
+import fcntl
+import struct
+from fward_env import write_file_atomic
+
+# Scrub monitoring. The progress of a running scrub is read per device with BTRFS_IOC_SCRUB_PROGRESS,
+# a single ioctl that copies the counters of the scrub and does not slow it down.
+# python-btrfs has no scrub support, so the ioctl is built here in the same way it builds its own.
+
+# struct btrfs_scrub_progress, in order.
+SCRUB_PROGRESS_FIELDS = (
+    'data_extents_scrubbed', 'tree_extents_scrubbed', 'data_bytes_scrubbed', 'tree_bytes_scrubbed',
+    'read_errors', 'csum_errors', 'verify_errors', 'no_csum', 'csum_discards', 'super_errors',
+    'malloc_errors', 'uncorrectable_errors', 'corrected_errors', 'last_physical', 'unverified_errors',
+)
+
+# struct btrfs_ioctl_scrub_args: devid, start, end, flags, the progress, padded to 1024 bytes.
+ioctl_scrub_args = struct.Struct('=4Q15Q872x')
+
+# The errors that are alerted on when a scrub finds new ones.
+SCRUB_ERROR_FIELDS = ('csum_errors', 'verify_errors', 'uncorrectable_errors')
+
+# Where btrfs scrub start keeps the status of the last scrub per filesystem, as scrub.status.<fsid>.
+SCRUB_STATUS_DIR = '/var/lib/btrfs'
+
+SCRUB_STATE_VERSION = 1
+
+IOC_SCRUB_PROGRESS = None
+
+class ScrubProgress:
+    __slots__ = SCRUB_PROGRESS_FIELDS
+    def __init__(self, *values):
+        for name, value in zip(SCRUB_PROGRESS_FIELDS, values):
+            setattr(self, name, value)
+
+    def bytes_scrubbed(self):
+        return self.data_bytes_scrubbed + self.tree_bytes_scrubbed
+
+    def errors(self):
+        return [getattr(self, name) for name in SCRUB_ERROR_FIELDS]
+
+# The scrub of one device: progress is None when no scrub is running,
+# last_finished is when the last scrub that ran to the end finished, or None if that is not known,
+# last_errors are the errors that scrub found in the order of SCRUB_ERROR_FIELDS.
+class DeviceScrub:
+    __slots__ = ('devid', 'device', 'uuid', 'bytes_used', 'progress', 'last_finished', 'last_errors')
+    def __init__(self, devid, device, uuid, bytes_used, progress, last_finished=None, last_errors=None):
+        self.devid = devid
+        self.device = device
+        self.uuid = uuid
+        self.bytes_used = bytes_used
+        self.progress = progress
+        self.last_finished = last_finished
+        self.last_errors = last_errors
+
+# Returns the progress of the scrub running on the device, or None when there is none.
+def scrub_progress(fd, devid):
+    global IOC_SCRUB_PROGRESS
+    if IOC_SCRUB_PROGRESS is None:
+        import btrfs
+        IOC_SCRUB_PROGRESS = btrfs.ioctl._IOWR(btrfs.ioctl.BTRFS_IOCTL_MAGIC, 29, ioctl_scrub_args)
+    buf = bytearray(ioctl_scrub_args.size)
+    ioctl_scrub_args.pack_into(buf, 0, devid, 0, 0, 0, *[0] * len(SCRUB_PROGRESS_FIELDS))
+    try:
+        fcntl.ioctl(fd, IOC_SCRUB_PROGRESS, buf)
+    except OSError as e:
+        if e.errno == errno.ENOTCONN:
+            return None
+        raise
+    return ScrubProgress(*ioctl_scrub_args.unpack(buf)[4:])
+
+# Reads the scrub status file of btrfs-progs, returns the fields per devid.
+# Lines look like: <fsid>:<devid>|data_extents_scrubbed:1|...|t_start:1700000000|duration:60|canceled:0|finished:1
+def read_scrub_status(status_dir, fsid):
+    path = os.path.join(status_dir, f'scrub.status.{fsid}')
+    if not os.path.exists(path):
+        return {}
+    devices = {}
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.strip().split('|')
+            if ':' not in fields[0] or not fields[0].startswith(str(fsid)):
+                continue
+            try:
+                devid = int(fields[0].rsplit(':', 1)[1])
+                devices[devid] = {key: int(value) for key, value in (field.split(':', 1) for field in fields[1:] if ':' in field)}
+            except ValueError:
+                continue
+    return devices
+
+def last_finished_scrub(status):
+    if not status or not status.get('finished') or status.get('canceled'):
+        return None
+    return status.get('t_start', 0) + status.get('duration', 0)
+
+# Reads the scrub of every device of an open btrfs.FileSystem.
+def read_device_scrubs(fs, status_dir=SCRUB_STATUS_DIR):
+    status = read_scrub_status(status_dir, fs.fsid)
+    scrubs = []
+    for device in fs.devices():
+        info = fs.dev_info(device.devid)
+        last = status.get(device.devid)
+        last_finished = last_finished_scrub(last)
+        last_errors = [last.get(name, 0) for name in SCRUB_ERROR_FIELDS] if last_finished is not None else None
+        scrubs.append(DeviceScrub(device.devid, info.path, str(info.uuid), info.bytes_used, scrub_progress(fs.fd, device.devid), last_finished, last_errors))
+    return scrubs
+
+def format_bytes(count):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if count < 1024:
+            return f'{count:.1f} {unit}'
+        count /= 1024
+    return f'{count:.1f} TiB'
+
+# Follows the scrubs between runs, in a small JSON state file per device UUID:
+# whether a scrub was running, how far it was and when, and the errors it had found.
+# check() returns (level, message) tuples, level is 'progress', 'info', 'warn' or 'error'.
+# Only progress is not meant for the notifier, it is logged on every poll.
+class ScrubMonitor:
+    def __init__(self, state_file, max_age=0):
+        self.state_file = state_file
+        self.max_age = max_age
+        self.devices = self.load()
+
+    def load(self):
+        if not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file, 'r') as f:
+                data = json.load(f)
+        except ValueError:
+            return {}
+        if data.get('version') != SCRUB_STATE_VERSION:
+            return {}
+        return data['devices']
+
+    def save(self):
+        write_file_atomic(self.state_file, json.dumps({'version': SCRUB_STATE_VERSION, 'devices': self.devices}))
+
+    def check(self, mount_point, scrub, now):
+        messages = []
+        previous = self.devices.get(scrub.uuid, {})
+        state = {'running': False, 'bytes': 0, 'at': now, 'errors': [0] * len(SCRUB_ERROR_FIELDS), 'overdue_alerted': previous.get('overdue_alerted', 0)}
+        progress = scrub.progress
+        if progress is not None:
+            scrubbed = progress.bytes_scrubbed()
+            # Fewer bytes than last time means a new scrub started since.
+            same_scrub = previous.get('running') and scrubbed >= previous['bytes']
+            if not same_scrub:
+                messages.append(('info', f'Scrub started on device {scrub.device} in {mount_point}'))
+            seen_errors = previous['errors'] if same_scrub else [0] * len(SCRUB_ERROR_FIELDS)
+            messages.extend(self.new_errors(mount_point, scrub.device, seen_errors, progress.errors()))
+            done = f'{scrubbed / scrub.bytes_used * 100:.1f}%' if scrub.bytes_used else format_bytes(scrubbed)
+            rate = ''
+            if same_scrub and now > previous['at']:
+                rate = f', {format_bytes((scrubbed - previous["bytes"]) / (now - previous["at"]))}/s'
+            messages.append(('progress', f'Scrub of device {scrub.device} in {mount_point}: {done} done{rate}'))
+            state.update(running=True, bytes=scrubbed, errors=progress.errors())
+        elif previous.get('running'):
+            messages.append(('info', f'Scrub ended on device {scrub.device} in {mount_point}'))
+            # What it found after the last poll is only in the status file of the finished scrub.
+            if scrub.last_errors is not None and scrub.last_finished >= previous['at']:
+                messages.extend(self.new_errors(mount_point, scrub.device, previous['errors'], scrub.last_errors))
+        if progress is None and self.max_age:
+            overdue = scrub.last_finished is None or now - scrub.last_finished > self.max_age
+            # Repeated once a day while it stays overdue.
+            if overdue and now - state['overdue_alerted'] >= 86400:
+                since = 'no complete scrub is on record' if scrub.last_finished is None else f'the last one finished {(now - scrub.last_finished) / 86400:.0f} days ago'
+                messages.append(('warn', f'Scrub of device {scrub.device} in {mount_point} is overdue, {since}'))
+                state['overdue_alerted'] = now
+        self.devices[scrub.uuid] = state
+        return messages
+
+    @staticmethod
+    def new_errors(mount_point, device, seen, current):
+        messages = []
+        for name, old, new in zip(SCRUB_ERROR_FIELDS, seen, current):
+            if new > old:
+                messages.append(('error', f'Scrub found {new - old} new {name.replace("_", " ")} on device {device} in {mount_point}, {new} in this scrub'))
+        return messages
@@ -0,0 +1,205 @@
+import time
+import random
+from fward_scrub import DeviceScrub
+from fward_space import DeviceSpace, FilesystemSpace, GIB
+from fward_subvolumes import Subvolume, Qgroup, SubvolumeStatus
+
+# A backend that simulates a fleet of btrfs filesystems, for benchmarks and trying out fward without btrfs pools.
+# Everything lives in memory and is generated from a seed, so two runs with the same settings see the same data.
+# Time only moves on advance(): device counters go up and new kernel warnings are logged.
+
+MOUNT_ROOT = '/sim'
+
+# The top level subvolume and the id of the first one created, as in btrfs.ctree.
+FS_TREE_OBJECTID = 5
+FIRST_FREE_OBJECTID = 256
+
+# Warning lines in the formats the kernel logs them in.
+CSUM_WARNING = 'BTRFS warning (device {device}): csum failed root 5 ino {ino} off {offset} csum 0x8941f998 expected csum 0x1e1f4d5b mirror 1'
+LOGICAL_WARNING = 'BTRFS warning (device {device}): checksum error at logical {logical} on dev /dev/{device}, physical {physical}, root 5, inode {ino}, offset {offset}, length 4096, links 1 (path: data/file{ino})'
+
+# Logical addresses of a simulated filesystem are the inode number times this.
+LOGICAL_STRIDE = 1 << 20
+
+class SimulatedDevice:
+    __slots__ = ('devid', 'path', 'uuid', 'write_errs', 'read_errs', 'flush_errs', 'corruption_errs', 'generation_errs')
+    def __init__(self, devid, path, uuid):
+        self.devid = devid
+        self.path = path
+        self.uuid = uuid
+        self.write_errs = 0
+        self.read_errs = 0
+        self.flush_errs = 0
+        self.corruption_errs = 0
+        self.generation_errs = 0
+
+# The same device object answers dev_info (path, uuid) and dev_stats (the counters).
+class SimulatedFileSystem:
+    def __init__(self, mount_point, devices):
+        self.mount_point = mount_point
+        self.by_devid = {device.devid: device for device in devices}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def devices(self):
+        return list(self.by_devid.values())
+
+    def dev_info(self, devid):
+        return self.by_devid[devid]
+
+    def dev_stats(self, devid):
+        return self.by_devid[devid]
+
+class SimulatedMountTable:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def btrfs_filesystems(self):
+        return self.backend.find_filesystems()
+
+    def close(self):
+        pass
+
+# Reads the simulated kernel log from the last committed position, like JournalReader does from its cursor.
+# Without a committed position the last backlog lines are read.
+class SimulatedJournal:
+    def __init__(self, backend, backlog):
+        self.backend = backend
+        self.start = backend.journal_position if backend.journal_position is not None else max(0, backend.log_size - backlog)
+        self.end = self.start
+        self.lines_read = 0
+
+    def lines(self):
+        for index in range(self.start, self.backend.log_size):
+            self.end = index + 1
+            self.lines_read += 1
+            yield self.backend.log_line(index)
+
+    def commit(self):
+        self.backend.journal_position = self.end
+
+# Returns the lines logged by advance() since the last poll.
+class SimulatedKernelLog:
+    def __init__(self, backend, grep):
+        self.backend = backend
+        self.grep = grep
+        self.position = backend.log_size
+        self.source = 'simulated'
+
+    def poll(self, timeout):
+        if self.position == self.backend.log_size:
+            time.sleep(timeout)
+            return []
+        lines = [self.backend.log_line(index) for index in range(self.position, self.backend.log_size)]
+        self.position = self.backend.log_size
+        return [line for line in lines if self.grep in line]
+
+    def close(self):
+        pass
+
+# filesystems filesystems with devices_per_filesystem devices each, mounted subvolumes times.
+# Every advance() a device gets a new error with a chance of error_rate, and warnings_per_step warnings are logged.
+# The log starts with warnings lines, about files_per_filesystem inodes per filesystem.
+class SimulatedBtrfs:
+    def __init__(self, filesystems=10, devices_per_filesystem=4, subvolumes=1, warnings=1000, warnings_per_step=10, error_rate=0.01, files_per_filesystem=1000, seed=0):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.warnings_per_step = warnings_per_step
+        self.error_rate = error_rate
+        self.files_per_filesystem = files_per_filesystem
+        self.subvolumes = subvolumes
+        self.mount_points = []
+        self.filesystems = {}
+        self.device_names = []
+        for index in range(filesystems):
+            mount_point = f'{MOUNT_ROOT}/pool{index}'
+            self.mount_points.append([mount_point] + [f'{mount_point}/subvolume{subvolume}' for subvolume in range(1, subvolumes)])
+            devices = []
+            for devid in range(1, devices_per_filesystem + 1):
+                number = len(self.device_names)
+                name = f'sim{number}'
+                self.device_names.append(name)
+                devices.append(SimulatedDevice(devid, f'/dev/{name}', f'00000000-0000-0000-{index:04d}-{number:012d}'))
+            self.filesystems[mount_point] = devices
+        self.log_size = warnings
+        self.journal_position = None
+
+    def all_devices(self):
+        return [device for devices in self.filesystems.values() for device in devices]
+
+    def advance(self, steps=1):
+        devices = self.all_devices()
+        for _ in range(steps):
+            for device in devices:
+                if self.rng.random() < self.error_rate:
+                    if self.rng.random() < 0.5:
+                        device.corruption_errs += 1
+                    else:
+                        device.read_errs += 1
+            self.log_size += self.warnings_per_step
+
+    # The warning at a position in the log, derived from the position so the log does not have to be kept.
+    def log_line(self, index):
+        rng = random.Random(self.seed * 1000003 + index)
+        device = self.device_names[rng.randrange(len(self.device_names))]
+        ino = 257 + rng.randrange(self.files_per_filesystem)
+        offset = rng.randrange(256) * 4096
+        if rng.random() < 0.5:
+            return CSUM_WARNING.format(device=device, ino=ino, offset=offset)
+        logical = ino * LOGICAL_STRIDE + offset
+        return LOGICAL_WARNING.format(device=device, logical=logical, physical=logical + LOGICAL_STRIDE, ino=ino, offset=offset)
+
+    def mount_table(self):
+        return SimulatedMountTable(self)
+
+    def find_filesystems(self):
+        return [list(mount_points) for mount_points in self.mount_points]
+
+    def open_filesystem(self, mount_point):
+        if mount_point not in self.filesystems:
+            raise FileNotFoundError(f'No simulated filesystem at {mount_point}')
+        return SimulatedFileSystem(mount_point, self.filesystems[mount_point])
+
+    # No scrubs run on the simulated filesystems.
+    def scrub_status(self, fs, status_dir):
+        return [DeviceScrub(device.devid, device.path, device.uuid, 0, None) for device in fs.devices()]
+
+    # Every filesystem is RAID1 on devices of 4 TiB, about three quarters allocated.
+    def space_status(self, fs, cache):
+        devices = fs.devices()
+        data = len(devices) * 1536 * GIB
+        metadata = len(devices) * 8 * GIB
+        system = len(devices) * 32 * (1 << 20)
+        types = {'data': [data, data * 9 // 10], 'metadata': [metadata, metadata // 2], 'system': [system, system // 64]}
+        by_type = {'data': 2 * data // len(devices), 'metadata': 2 * metadata // len(devices), 'system': 2 * system // len(devices)}
+        spaces = [DeviceSpace(device.devid, device.path, 4096 * GIB, sum(by_type.values()), dict(by_type)) for device in devices]
+        return FilesystemSpace(types, dict.fromkeys(types, 'raid1'), 512 * (1 << 20), spaces)
+
+    # Every filesystem has its mounted subvolumes, each in a qgroup that grows with the log, the first one limited to 1 TiB.
+    def subvolume_status(self, fs, cache):
+        subvolumes = {FS_TREE_OBJECTID: Subvolume(FS_TREE_OBJECTID, 0, '', self.log_size, False)}
+        qgroups = {}
+        for index in range(1, self.subvolumes):
+            subvolid = FIRST_FREE_OBJECTID + index - 1
+            path = f'subvolume{index}'
+            subvolumes[subvolid] = Subvolume(subvolid, FS_TREE_OBJECTID, path, self.log_size, False)
+            referenced = index * 100 * GIB + self.log_size * (1 << 20)
+            qgroups[subvolid] = Qgroup(f'0/{subvolid}', path, referenced, referenced // 2, 1024 * GIB if index == 1 else None, None, None)
+        return SubvolumeStatus(subvolumes, qgroups, 0)
+
+    def journal(self, cursor_file, grep, backlog, since=None):
+        return SimulatedJournal(self, backlog)
+
+    def kernel_log(self, grep):
+        return SimulatedKernelLog(self, grep)
+
+    def resolve_filesystem(self, mount_point, references, handles=None, cache=None):
+        paths = []
+        for kind, number, root in references:
+            ino = int(number) if kind == 'inode' else int(number) // LOGICAL_STRIDE
+            paths.append(f'{mount_point}/data/file{ino}')
+        return paths
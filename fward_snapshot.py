@@ -0,0 +1,54 @@
+import json
+from fward_models import *
+
+# The cache file format. A small JSON document:
+# {"version": 2, "mounts": [[mount_point, [[device, uuid, write, read, flush, corruption, generation], ...], [alias, ...]], ...]}
+# It stays readable and editable by hand, and the json module parses it in C.
+# Version 1 is the same without the aliases.
+SNAPSHOT_VERSION = 2
+SNAPSHOT_VERSIONS = {1, 2}
+
+def encode_snapshot(mounts):
+    return [[mount.mount_point, [[device.device, device.uuid, *device.stats.counters()] for device in mount.devices], mount.aliases] for mount in mounts]
+
+def decode_snapshot(encoded):
+    return [BtrfsMountPoint(mount_point, [BtrfsDevice(device, uuid, BtrfsDeviceStats(*counters)) for device, uuid, *counters in devices], *aliases) for mount_point, devices, *aliases in encoded]
+
+def dumps_snapshot(mounts):
+    return json.dumps({'version': SNAPSHOT_VERSION, 'mounts': encode_snapshot(mounts)}, separators=(',', ':'))
+
+# Returns the mounts, or None if the snapshot is empty, broken or of a version we don't know.
+def loads_snapshot(data):
+    try:
+        document = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(document, dict) or document.get('version') not in SNAPSHOT_VERSIONS:
+        return None
+    return decode_snapshot(document['mounts'])
+
+# Snapshots are JSON objects, anything else is the YAML cache of v0.2 and older.
+# An empty file is neither, the old cache write could leave one behind when it crashed.
+def is_legacy_snapshot(data):
+    data = data.lstrip()
+    return bool(data) and not data.startswith(b'{')
+
+# Reads the YAML cache written by v0.2 and older, with its !BtrfsMountPoint, !BtrfsDevice and !BtrfsDeviceStats tags.
+# yaml is only imported here, it is not needed once the cache has been migrated.
+# Returns None when the file is not such a cache.
+def loads_legacy_snapshot(data):
+    import yaml
+
+    class LegacyLoader(yaml.SafeLoader):
+        pass
+
+    def construct(cls):
+        return lambda loader, node: cls(**loader.construct_mapping(node, deep=True))
+    LegacyLoader.add_constructor('!BtrfsDeviceStats', construct(BtrfsDeviceStats))
+    LegacyLoader.add_constructor('!BtrfsDevice', construct(BtrfsDevice))
+    LegacyLoader.add_constructor('!BtrfsMountPoint', construct(BtrfsMountPoint))
+    try:
+        mounts = yaml.load(data, Loader=LegacyLoader)
+    except (yaml.YAMLError, TypeError):
+        return None
+    return mounts if isinstance(mounts, list) else None
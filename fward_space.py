@@ -0,0 +1,172 @@
+import time
+from fward_env import FilesystemState
+from fward_profile import profile_count
+
+# Space and allocation of a filesystem.
+# What is allocated and used per type comes from BTRFS_IOC_SPACE_INFO, and what is allocated per device from
+# BTRFS_IOC_DEV_INFO. Both are a single cheap ioctl and are read on every run.
+# How the allocation of a device splits over data, metadata and system needs a walk of the chunk tree, which takes
+# long on big filesystems. Its result is cached, and only walked again when the chunk tree changed or the
+# refresh interval passed.
+
+SPACE_CACHE_VERSION = 1
+
+GIB = 1 << 30
+
+# Block group flags, as in btrfs.ctree, so the module can be used without importing btrfs.
+BLOCK_GROUP_DATA = 1 << 0
+BLOCK_GROUP_SYSTEM = 1 << 1
+BLOCK_GROUP_METADATA = 1 << 2
+BLOCK_GROUP_TYPE_MASK = BLOCK_GROUP_DATA | BLOCK_GROUP_SYSTEM | BLOCK_GROUP_METADATA
+SPACE_INFO_GLOBAL_RSV = 1 << 49
+PROFILES = {
+    1 << 3: 'raid0', 1 << 4: 'raid1', 1 << 5: 'dup', 1 << 6: 'raid10', 1 << 7: 'raid5', 1 << 8: 'raid6',
+    1 << 9: 'raid1c3', 1 << 10: 'raid1c4',
+}
+# The number of devices with unallocated space a new chunk of the profile needs, DUP needs one with room for two.
+PROFILE_DEVICES = {'single': 1, 'dup': 1, 'raid0': 1, 'raid1': 2, 'raid1c3': 3, 'raid1c4': 4, 'raid10': 2, 'raid5': 2, 'raid6': 3}
+
+def block_group_type(flags):
+    flags &= BLOCK_GROUP_TYPE_MASK
+    if flags == BLOCK_GROUP_DATA | BLOCK_GROUP_METADATA:
+        return 'mixed'
+    if flags & BLOCK_GROUP_DATA:
+        return 'data'
+    if flags & BLOCK_GROUP_METADATA:
+        return 'metadata'
+    return 'system'
+
+def block_group_profile(flags):
+    for flag, name in PROFILES.items():
+        if flags & flag:
+            return name
+    return 'single'
+
+# The space of one device: size and allocated from dev_info, by_type from the (cached) chunk tree walk.
+class DeviceSpace:
+    __slots__ = ('devid', 'device', 'size', 'allocated', 'by_type')
+    def __init__(self, devid, device, size, allocated, by_type):
+        self.devid = devid
+        self.device = device
+        self.size = size
+        self.allocated = allocated
+        self.by_type = by_type
+
+    def unallocated(self):
+        return self.size - self.allocated
+
+# types maps data, metadata, system (or mixed) to [allocated, used], profiles maps them to their profile.
+# global_reserve is the metadata the filesystem keeps back for itself.
+class FilesystemSpace:
+    __slots__ = ('types', 'profiles', 'global_reserve', 'devices')
+    def __init__(self, types, profiles, global_reserve, devices):
+        self.types = types
+        self.profiles = profiles
+        self.global_reserve = global_reserve
+        self.devices = devices
+
+# The allocated space of a chunk on each of its devices.
+def stripe_length(chunk):
+    profile = block_group_profile(chunk.type)
+    if profile == 'raid0':
+        return chunk.length // chunk.num_stripes
+    if profile == 'raid10':
+        return chunk.length * chunk.sub_stripes // chunk.num_stripes
+    if profile == 'raid5':
+        return chunk.length // (chunk.num_stripes - 1)
+    if profile == 'raid6':
+        return chunk.length // (chunk.num_stripes - 2)
+    return chunk.length
+
+# Searches the chunk items of the chunk tree, leaving out the device items next to them.
+# A device item changes whenever the allocation of its device does, which would look like a chunk tree change.
+def search_chunk_items(fs, min_transid=0, nr_items=None):
+    import btrfs
+    min_key = btrfs.ctree.Key(btrfs.ctree.FIRST_CHUNK_TREE_OBJECTID, btrfs.ctree.CHUNK_ITEM_KEY, 0)
+    max_key = btrfs.ctree.Key(btrfs.ctree.FIRST_CHUNK_TREE_OBJECTID, btrfs.ctree.CHUNK_ITEM_KEY, btrfs.ctree.ULLONG_MAX)
+    return btrfs.ioctl.search_v2(fs.fd, btrfs.ctree.CHUNK_TREE_OBJECTID, min_key, max_key, min_transid=min_transid, nr_items=nr_items)
+
+# Walks the chunk items and returns the allocated bytes per devid and type, and the generation of the walk:
+# the newest generation of the leaves holding them.
+def walk_chunk_tree(fs):
+    import btrfs
+    generation = 0
+    by_device = {}
+    for header, data in search_chunk_items(fs):
+        generation = max(generation, header.transid)
+        chunk = btrfs.ctree.Chunk(header, data)
+        length = stripe_length(chunk)
+        chunk_type = block_group_type(chunk.type)
+        for stripe in chunk.stripes:
+            per_type = by_device.setdefault(str(stripe.devid), {})
+            per_type[chunk_type] = per_type.get(chunk_type, 0) + length
+    return generation, by_device
+
+# Whether a chunk item was written after the generation.
+# The search skips every part of the tree that is older, so this costs next to nothing when nothing changed.
+def chunk_tree_changed(fs, generation):
+    for _ in search_chunk_items(fs, generation + 1, 1):
+        return True
+    return False
+
+# The cached chunk tree walks, per fsid, and the space alerts that were sent.
+class SpaceCache(FilesystemState):
+    def __init__(self, cache_file, refresh_interval):
+        super().__init__(cache_file, SPACE_CACHE_VERSION)
+        self.refresh_interval = refresh_interval
+
+    # Returns the allocation per devid and type, walking the chunk tree only when the cached walk is out of date.
+    def chunk_allocation(self, fs):
+        fsid = str(fs.fsid)
+        with self.lock:
+            cached = self.filesystems.get(fsid)
+        now = time.time()
+        if cached is not None and now - cached['walked_at'] < self.refresh_interval and not chunk_tree_changed(fs, cached['generation']):
+            return cached['devices']
+        generation, by_device = walk_chunk_tree(fs)
+        profile_count('chunk_tree_walks')
+        with self.lock:
+            self.filesystems[fsid] = {'generation': generation, 'walked_at': now, 'devices': by_device}
+        return by_device
+
+# Reads the space of an open btrfs.FileSystem, with the per device split from the cache.
+def read_filesystem_space(fs, cache):
+    types = {}
+    profiles = {}
+    global_reserve = 0
+    for space in fs.space_info():
+        if space.flags & SPACE_INFO_GLOBAL_RSV:
+            global_reserve = space.total_bytes
+            continue
+        space_type = block_group_type(space.flags)
+        allocated, used = types.get(space_type, [0, 0])
+        types[space_type] = [allocated + space.total_bytes, used + space.used_bytes]
+        profiles[space_type] = block_group_profile(space.flags)
+    by_device = cache.chunk_allocation(fs)
+    devices = []
+    for device in fs.devices():
+        info = fs.dev_info(device.devid)
+        devices.append(DeviceSpace(device.devid, info.path, info.total_bytes, info.bytes_used, by_device.get(str(device.devid), {})))
+    return FilesystemSpace(types, profiles, global_reserve, devices)
+
+# Whether a new chunk of the type fits in the unallocated space of the devices.
+def room_for_chunk(space, space_type, min_unallocated):
+    profile = space.profiles.get(space_type, 'single')
+    needed = min_unallocated * 2 if profile == 'dup' else min_unallocated
+    return sum(1 for device in space.devices if device.unallocated() >= needed) >= PROFILE_DEVICES.get(profile, 1)
+
+# Returns (key, message) for every problem with the space: metadata running out while there is no room
+# left to allocate more, and data chunks with a lot of unused space while there is no unallocated space.
+# Both are what a balance is for.
+def space_problems(mount_point, space, min_unallocated, metadata_usage):
+    problems = []
+    metadata_type = 'mixed' if 'mixed' in space.types else 'metadata'
+    allocated, used = space.types.get(metadata_type, [0, 0])
+    if allocated and not room_for_chunk(space, metadata_type, min_unallocated):
+        usage = (used + space.global_reserve) / allocated
+        if usage >= metadata_usage:
+            problems.append(('metadata', f'Metadata of {mount_point} is {usage * 100:.0f}% full including the global reserve, and there is no unallocated space for more. Balance data chunks to free some, e.g. btrfs balance start -dusage=50 {mount_point}'))
+    allocated, used = space.types.get('data', [0, 0])
+    if allocated and not room_for_chunk(space, 'data', min_unallocated) and allocated - used >= min_unallocated:
+        problems.append(('data', f'Data chunks of {mount_point} have {(allocated - used) / GIB:.1f} GiB unused, but there is no unallocated space left. A balance is needed, e.g. btrfs balance start -dusage=50 {mount_point}'))
+    return problems
@@ -0,0 +1,234 @@
+import time
+import errno
+import struct
+from fward_env import FilesystemState
+from fward_profile import profile_count
+from fward_space import GIB
+from fward_resolve import subvolume_path
+
+# Subvolumes and qgroups of a filesystem.
+# The subvolumes are the root items and back references in the root tree, the usage is in the qgroup items of the
+# quota tree. Both are cached per filesystem. A run only searches what was written after the generation of the
+# cache, the kernel skips every older part of the trees, so on a pool with thousands of snapshots only the
+# subvolumes and qgroups that changed are read again.
+# A search like that does not see what was removed, so everything is read in full every refresh interval.
+
+SUBVOLUME_CACHE_VERSION = 2
+
+# struct btrfs_qgroup_info_item: generation, referenced, referenced_compressed, exclusive, exclusive_compressed.
+qgroup_info_item = struct.Struct('<5Q')
+# struct btrfs_qgroup_limit_item: flags, max_referenced, max_exclusive, rsv_referenced, rsv_exclusive.
+qgroup_limit_item = struct.Struct('<5Q')
+# Flags of a qgroup limit item, which btrfs.ctree does not have.
+QGROUP_LIMIT_MAX_RFER = 1 << 0
+QGROUP_LIMIT_MAX_EXCL = 1 << 1
+
+# How long the growth of a qgroup is measured over before it starts over, and how long at least.
+GROWTH_WINDOW = 86400
+GROWTH_MIN_WINDOW = 3600
+
+def qgroup_name(qgroupid):
+    import btrfs
+    return f'{btrfs.ctree.qgroup_level(qgroupid)}/{btrfs.ctree.qgroup_subvid(qgroupid)}'
+
+def is_subvolume(objectid):
+    import btrfs
+    return objectid == btrfs.ctree.FS_TREE_OBJECTID or btrfs.ctree.FIRST_FREE_OBJECTID <= objectid <= btrfs.ctree.LAST_FREE_OBJECTID
+
+# path is relative to the top level subvolume, as btrfs subvolume list shows it.
+class Subvolume:
+    __slots__ = ('id', 'parent', 'path', 'generation', 'readonly')
+    def __init__(self, id, parent, path, generation, readonly):
+        self.id = id
+        self.parent = parent
+        self.path = path
+        self.generation = generation
+        self.readonly = readonly
+
+# The limits are None when not set. growth is in bytes referenced per day, None until measured long enough.
+class Qgroup:
+    __slots__ = ('name', 'path', 'referenced', 'exclusive', 'max_referenced', 'max_exclusive', 'growth')
+    def __init__(self, name, path, referenced, exclusive, max_referenced, max_exclusive, growth):
+        self.name = name
+        self.path = path
+        self.referenced = referenced
+        self.exclusive = exclusive
+        self.max_referenced = max_referenced
+        self.max_exclusive = max_exclusive
+        self.growth = growth
+
+# qgroups is empty when quotas are not enabled. reread is how many subvolumes and qgroups were read this run.
+class SubvolumeStatus:
+    __slots__ = ('subvolumes', 'qgroups', 'reread')
+    def __init__(self, subvolumes, qgroups, reread):
+        self.subvolumes = subvolumes
+        self.qgroups = qgroups
+        self.reread = reread
+
+def search_root_tree(fs, min_transid):
+    import btrfs
+    min_key = btrfs.ctree.Key(btrfs.ctree.FS_TREE_OBJECTID, btrfs.ctree.ROOT_ITEM_KEY, 0)
+    max_key = btrfs.ctree.Key(btrfs.ctree.LAST_FREE_OBJECTID, btrfs.ctree.ROOT_BACKREF_KEY, btrfs.ctree.ULLONG_MAX)
+    return btrfs.ioctl.search_v2(fs.fd, btrfs.ctree.ROOT_TREE_OBJECTID, min_key, max_key, min_transid=min_transid)
+
+# Returns None when quotas are not enabled.
+def search_quota_tree(fs, min_transid):
+    import btrfs
+    min_key = btrfs.ctree.Key(0, btrfs.ctree.QGROUP_INFO_KEY, 0)
+    max_key = btrfs.ctree.Key(0, btrfs.ctree.QGROUP_LIMIT_KEY, btrfs.ctree.ULLONG_MAX)
+    try:
+        return list(btrfs.ioctl.search_v2(fs.fd, btrfs.ctree.QUOTA_TREE_OBJECTID, min_key, max_key, min_transid=min_transid))
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+# Where a subvolume is, relative to the top level subvolume. Falls back to its name when the path can't be found.
+def lookup_path(fs, subvolume, name):
+    try:
+        return subvolume_path(fs, subvolume)
+    except OSError:
+        return name
+
+# The cached subvolumes and qgroups, per fsid:
+#   subvolumes  id: [parent, dirid, name, path, generation, readonly]
+#   qgroups     qgroupid: [referenced, exclusive, max_referenced, max_exclusive, growth_since, referenced_since]
+class SubvolumeCache(FilesystemState):
+    def __init__(self, cache_file, refresh_interval):
+        super().__init__(cache_file, SUBVOLUME_CACHE_VERSION)
+        self.refresh_interval = refresh_interval
+
+    # Reads what changed since the last run into the cached state of the filesystem, and returns its status.
+    def update(self, fs):
+        fsid = str(fs.fsid)
+        now = time.time()
+        with self.lock:
+            cached = self.filesystems.get(fsid)
+        full = cached is None or now - cached['refreshed_at'] >= self.refresh_interval
+        if cached is None:
+            cached = {'refreshed_at': now, 'generation': 0, 'subvolumes': {}, 'qgroup_generation': 0, 'qgroups': {}}
+        elif full:
+            cached['refreshed_at'] = now
+        reread = self.update_subvolumes(fs, cached, full)
+        reread += self.update_qgroups(fs, cached, now, full)
+        profile_count('subvolumes_reread', reread)
+        with self.lock:
+            self.filesystems[fsid] = cached
+        return self.status(cached, now, reread)
+
+    def update_subvolumes(self, fs, cached, full):
+        import btrfs
+        subvolumes = cached['subvolumes']
+        generation = 0 if full else cached['generation']
+        seen = set()
+        changed = set()
+        moved = False
+        for header, data in search_root_tree(fs, generation + 1 if generation else 0):
+            generation = max(generation, header.transid)
+            if not is_subvolume(header.objectid):
+                continue
+            key = str(header.objectid)
+            entry = subvolumes.get(key)
+            if header.type == btrfs.ctree.ROOT_ITEM_KEY:
+                root = btrfs.ctree.RootItem(header, data)
+                # A deleted subvolume keeps its root item without references until it is cleaned up.
+                if root.refs == 0:
+                    subvolumes.pop(key, None)
+                    continue
+                seen.add(key)
+                readonly = bool(root.flags & btrfs.ctree.ROOT_SUBVOL_RDONLY)
+                if entry is None:
+                    subvolumes[key] = [0, 0, '', None, root.generation, readonly]
+                    changed.add(key)
+                elif entry[4:6] != [root.generation, readonly]:
+                    entry[4:6] = [root.generation, readonly]
+                    changed.add(key)
+            elif header.type == btrfs.ctree.ROOT_BACKREF_KEY and entry is not None:
+                ref = btrfs.ctree.RootRef(header, data)
+                name = ref.name.decode(errors='replace')
+                if entry[:3] != [header.offset, ref.dirid, name]:
+                    # The subvolumes below a moved one moved along with it.
+                    moved = moved or entry[3] is not None
+                    entry[:4] = [header.offset, ref.dirid, name, None]
+                    changed.add(key)
+        if full:
+            for key in [key for key in subvolumes if key not in seen]:
+                del subvolumes[key]
+        if moved:
+            for entry in subvolumes.values():
+                entry[3] = None
+        # Only the path of a new or moved subvolume is looked up.
+        for key, entry in subvolumes.items():
+            if entry[3] is None:
+                entry[3] = lookup_path(fs, int(key), entry[2]) if entry[0] else ''
+        cached['generation'] = generation
+        return len(changed)
+
+    def update_qgroups(self, fs, cached, now, full):
+        import btrfs
+        items = search_quota_tree(fs, cached['qgroup_generation'] + 1 if not full else 0)
+        if items is None:
+            cached['qgroups'] = {}
+            return 0
+        qgroups = cached['qgroups']
+        if full:
+            # What is not found again was removed, the growth measured so far is kept.
+            seen = {str(header.offset) for header, _ in items}
+            for key in [key for key in qgroups if key not in seen]:
+                del qgroups[key]
+        generation = cached['qgroup_generation']
+        changed = set()
+        for header, data in items:
+            generation = max(generation, header.transid)
+            key = str(header.offset)
+            entry = qgroups.setdefault(key, [0, 0, None, None, now, None])
+            if header.type == btrfs.ctree.QGROUP_INFO_KEY:
+                _, referenced, _, exclusive, _ = qgroup_info_item.unpack_from(data)
+                if entry[:2] != [referenced, exclusive]:
+                    entry[:2] = [referenced, exclusive]
+                    changed.add(key)
+                if entry[5] is None:
+                    entry[5] = referenced
+            elif header.type == btrfs.ctree.QGROUP_LIMIT_KEY:
+                flags, max_referenced, max_exclusive, _, _ = qgroup_limit_item.unpack_from(data)
+                limits = [max_referenced if flags & QGROUP_LIMIT_MAX_RFER else None, max_exclusive if flags & QGROUP_LIMIT_MAX_EXCL else None]
+                if entry[2:4] != limits:
+                    entry[2:4] = limits
+                    changed.add(key)
+        # The growth is measured from a baseline that starts over once a day.
+        for entry in qgroups.values():
+            if entry[5] is None or now - entry[4] >= GROWTH_WINDOW:
+                entry[4:6] = [now, entry[0]]
+        cached['qgroup_generation'] = generation
+        return len(changed)
+
+    @staticmethod
+    def status(cached, now, reread):
+        import btrfs
+        subvolumes = {}
+        for key, (parent, _, _, path, generation, readonly) in cached['subvolumes'].items():
+            subvolumes[int(key)] = Subvolume(int(key), parent, path or '', generation, readonly)
+        qgroups = {}
+        for key, (referenced, exclusive, max_referenced, max_exclusive, since, referenced_since) in cached['qgroups'].items():
+            qgroupid = int(key)
+            subvolume = subvolumes.get(qgroupid) if btrfs.ctree.qgroup_level(qgroupid) == 0 else None
+            window = now - since
+            growth = (referenced - referenced_since) * 86400 / window if window >= GROWTH_MIN_WINDOW else None
+            qgroups[qgroupid] = Qgroup(qgroup_name(qgroupid), subvolume.path if subvolume else None, referenced, exclusive, max_referenced, max_exclusive, growth)
+        return SubvolumeStatus(subvolumes, qgroups, reread)
+
+# Reads the subvolumes and qgroups of an open btrfs.FileSystem, through the cache.
+def read_subvolume_status(fs, cache):
+    return cache.update(fs)
+
+# Returns (key, message) for every qgroup that is close to its limit or grows faster than growth_per_day bytes.
+def qgroup_problems(mount_point, status, limit_fraction, growth_per_day):
+    problems = []
+    for qgroup in status.qgroups.values():
+        what = f'Qgroup {qgroup.name}' + (f' ({qgroup.path})' if qgroup.path else '') + f' of {mount_point}'
+        for kind, used, limit in (('referenced', qgroup.referenced, qgroup.max_referenced), ('exclusive', qgroup.exclusive, qgroup.max_exclusive)):
+            if limit and used >= limit * limit_fraction:
+                problems.append((f'{qgroup.name}:{kind}', f'{what} uses {used / limit * 100:.0f}% of its {kind} limit, {used / GIB:.1f} of {limit / GIB:.1f} GiB'))
+        if growth_per_day and qgroup.growth is not None and qgroup.growth >= growth_per_day:
+            problems.append((f'{qgroup.name}:growth', f'{what} grows {qgroup.growth / GIB:.1f} GiB per day, it references {qgroup.referenced / GIB:.1f} GiB'))
+    return problems
@@ -0,0 +1,73 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import fward
+from fward_simulate import SimulatedBtrfs
+
+# Collects what would have been sent.
+class RecordingNotifier:
+    def __init__(self):
+        self.bodies = []
+
+    def notify(self, body, title, notify_type, mount=None):
+        self.bodies.append(body)
+
+    def flush(self):
+        return 0
+
+    def broken_files(self):
+        return [path for body in self.bodies if body.startswith('Broken files detected:') for path in body.splitlines()[1:]]
+
+# The daemon in --follow mode, against the simulated backend. Every pass ends in wait(), which is replaced by
+# step(daemon) of the test. A restart is a new daemon on the same backend and data directory.
+class FollowingDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        environment = {
+            'FWARD_DATA_DIR': self.directory.name,
+            'FWARD_FOLLOW_DEBOUNCE': '0',
+            'FWARD_FOLLOW_MAX_DELAY': '0',
+        }
+        self.environment = mock.patch.dict(os.environ, environment)
+        self.environment.start()
+        self.backend = SimulatedBtrfs(filesystems=2, devices_per_filesystem=2, warnings=20, warnings_per_step=20, files_per_filesystem=100000)
+
+    def tearDown(self):
+        self.environment.stop()
+        self.directory.cleanup()
+
+    def run_daemon(self, steps):
+        notifier = RecordingNotifier()
+        daemon = fward.FwardDaemon(fward.FwardConfig(), notifier, self.backend, follow=True)
+        steps = list(steps)
+        def wait(started):
+            steps.pop(0)(daemon)
+            if not steps:
+                daemon.running = False
+        daemon.wait = wait
+        daemon.run()
+        return notifier
+
+    # New warnings, followed until their burst was reported.
+    def log_and_follow(self, daemon):
+        self.backend.advance()
+        daemon.follow_kernel_log(0)
+
+    def test_restart_does_not_report_again(self):
+        # The first pass only writes the cache, the second one reads the journal.
+        first = self.run_daemon([lambda daemon: None, self.log_and_follow, self.log_and_follow])
+        reported = first.broken_files()
+        self.assertTrue(reported)
+        self.assertEqual(len(reported), len(set(reported)))
+        second = self.run_daemon([lambda daemon: None])
+        self.assertEqual(second.broken_files(), [])
+
+    def test_journal_pass_leaves_out_what_was_reported_live(self):
+        notifier = self.run_daemon([lambda daemon: None, self.log_and_follow, lambda daemon: None])
+        reported = notifier.broken_files()
+        self.assertTrue(reported)
+        self.assertEqual(len(reported), len(set(reported)))
+
+if __name__ == '__main__':
+    unittest.main()